@@ -1,3 +1,4 @@
+import importlib
 import sys
 from pathlib import Path
 
@@ -11,42 +12,128 @@ if str(ROOT_DIR) not in sys.path:
 
 # ==== LOGIN SYSTEM ====
 from db.login_page import show_login_page, logout_button
-from db.auth_jwt import is_authenticated, get_current_user
+from db.auth_jwt import get_current_user
 from db.security import require_role
 
-from db.seed_users import seed_users
-#from db.change_pw import change_password_popup
+# Seed user mặc định: chỉ chạy 1 lần cho mỗi process server (dùng chung mọi session)
+@st.cache_resource(show_spinner=False)
+def _seed_once():
+    from db.seed_users import seed_users
 
-seed_users()
-# log
-#from log.user_activity_view import view_my_activity
+    seed_users()
+    return True
+
+
+_seed_once()
 
 # ==== MODULE NGHIỆP VỤ ====
+# Các module nghiệp vụ (kéo theo pandas, openpyxl...) được import lazy
+# khi menu tương ứng được chọn để không phải trả chi phí import mỗi lần rerun.
 from module.error_utils import run_with_user_error
-from module.phoi_the import run_phoi_the
-from module.chuyen_tien import run_chuyen_tien
-from module.to_khai_hq import run_to_khai_hq
-from module.tindung import run_tin_dung
-from module.hdv import run_hdv
-from module.ngoai_te_vang import run_ngoai_te_vang
-from module.DVKH import run_dvkh_5_tieuchi
-from module.tieuchithe import run_module_the
-from module.module_pos import run_module_pos
+
+
+def _lazy(module_name, attr):
+    """Trả về hàm gọi module_name.attr — chỉ import module khi thực sự được gọi."""
+    def _call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), attr)(*args, **kwargs)
+
+    return _call
+
+
+# label menu -> (tiêu đề header, hàm chạy lazy, mô tả ngữ cảnh lỗi)
+MENU_ACTIONS = {
+    "📘 Phôi Thẻ – GTCG": (
+        "📘 PHÔI THẺ – GTCG",
+        _lazy("module.phoi_the", "run_phoi_the"),
+        "xử lý Phôi Thẻ – GTCG",
+    ),
+    "💸 Mục 09 – Chuyển tiền": (
+        "💸 CHUYỂN TIỀN",
+        _lazy("module.chuyen_tien", "run_chuyen_tien"),
+        "xử lý Mục 09 – Chuyển tiền",
+    ),
+    "📑 Tờ khai Hải quan": (
+        "📑 TỜ KHAI HẢI QUAN",
+        _lazy("module.to_khai_hq", "run_to_khai_hq"),
+        "xử lý Tờ khai Hải quan",
+    ),
+    "🏦 Tiêu chí tín dụng CRM4–32": (
+        "🏦 TÍN DỤNG CRM4 – CRM32",
+        _lazy("module.tindung", "run_tin_dung"),
+        "xử lý Tiêu chí tín dụng CRM4–32",
+    ),
+    "💼 HDV (TC1 – TC3)": (
+        "💼 HDV – TC1 đến TC3",
+        _lazy("module.hdv", "run_hdv"),
+        "xử lý HDV (TC1 – TC3)",
+    ),
+    "🌏 Ngoại tệ & Vàng (TC5 – TC6)": (
+        "🌏 NGOẠI TỆ & VÀNG",
+        _lazy("module.ngoai_te_vang", "run_ngoai_te_vang"),
+        "xử lý Ngoại tệ & Vàng",
+    ),
+    "👥 DVKH (5 tiêu chí)": (
+        "👥 DVKH – 5 TIÊU CHÍ",
+        _lazy("module.DVKH", "run_dvkh_5_tieuchi"),
+        "xử lý DVKH (5 tiêu chí)",
+    ),
+    "💳 Tiêu chí thẻ": (
+        "💳 TIÊU CHÍ THẺ",
+        _lazy("module.tieuchithe", "run_module_the"),
+        "xử lý Tiêu chí Thẻ",
+    ),
+    "💳 Tiêu chí máy pos": (
+        "💳 TIÊU CHÍ MÁY POS",
+        _lazy("module.module_pos", "run_module_pos"),
+        "xử lý Tiêu chí máy POS",
+    ),
+}
+
+# label menu -> danh sách quyền được truy cập (không khai báo = mọi user)
+MENU_ROLES = {
+    "💳 Tiêu chí máy pos": ["admin", "pos", "user"],
+}
+
+# chức năng quản trị duy nhất cần username của user hiện tại
+ADMIN_MY_ACTIVITY = "📜 Xem hoạt động user"
+
+# label chức năng quản trị -> hàm chạy lazy
+ADMIN_ACTIONS = {
+    "👤 Thêm user mới": _lazy("db.admin_user_manage", "create_user_form"),
+    "🔄 Reset mật khẩu user": _lazy("db.admin_reset_pw", "admin_reset_password"),
+    "📜 Xem Audit Trail": _lazy("db.admin_view_audit", "view_audit_logs"),
+    ADMIN_MY_ACTIVITY: _lazy("log.user_activity_view", "view_my_activity"),
+}
 
 
 # ==== HEADER UI ====
+_HEADER_CSS = """
+<style>
+.colored-header {
+    padding: 8px 12px;
+    margin-top: 10px;
+    margin-bottom: 12px;
+    background-color: #F5F9FF;
+}
+.colored-header p { opacity: 0.7; }
+</style>
+"""
+
+_HEADER_TMPL = (
+    '<div class="colored-header" style="border-left: 8px solid {color};">'
+    "<h2>{title}</h2><p>{subtitle}</p></div>"
+)
+
+
+@st.cache_resource(show_spinner=False)
+def _inject_header_css():
+    st.markdown(_HEADER_CSS, unsafe_allow_html=True)
+
+
 def colored_header(title, subtitle="", color="#4A90E2"):
+    _inject_header_css()
     st.markdown(
-        f"""
-        <div style="border-left: 8px solid {color};
-                    padding: 8px 12px;
-                    margin-top: 10px;
-                    margin-bottom: 12px;
-                    background-color: #F5F9FF;">
-            <h2>{title}</h2>
-            <p style="opacity:0.7;">{subtitle}</p>
-        </div>
-        """,
+        _HEADER_TMPL.format(color=color, title=title, subtitle=subtitle),
         unsafe_allow_html=True,
     )
 
@@ -54,12 +141,11 @@ def colored_header(title, subtitle="", color="#4A90E2"):
 # ============================================================
 # 🔐 KIỂM TRA LOGIN
 # ============================================================
-if not is_authenticated():
+user = get_current_user()
+if not user:
     show_login_page()
     st.stop()
 
-user = get_current_user()
-
 
 # ============================================================
 # SIDEBAR — LUÔN ĐƯỢC TẠO (KHÔNG BỊ LỖI menu not defined)
@@ -79,56 +165,27 @@ with st.sidebar:
 
         admin_menu = st.selectbox(
             "Chọn chức năng quản trị",
-            [
-                "— Chọn chức năng —",
-                "👤 Thêm user mới",
-                "🔄 Reset mật khẩu user",
-                "📜 Xem Audit Trail",
-                "📜 Xem hoạt động user"
-            ]
+            ["— Chọn chức năng —", *ADMIN_ACTIONS],
         )
 
-        if admin_menu == "👤 Thêm user mới":
-            from db.admin_user_manage import create_user_form
-            create_user_form()
-            st.stop()
-
-        elif admin_menu == "🔄 Reset mật khẩu user":
-            from db.admin_reset_pw import admin_reset_password
-            admin_reset_password()
+        admin_action = ADMIN_ACTIONS.get(admin_menu)
+        if admin_action:
+            if admin_menu == ADMIN_MY_ACTIVITY:
+                admin_action(user["username"])
+            else:
+                admin_action()
             st.stop()
 
-        elif admin_menu == "📜 Xem Audit Trail":
-            from db.admin_view_audit import view_audit_logs
-            view_audit_logs()
-            st.stop()
-
-        elif admin_menu == "📜 Xem hoạt động user":
-            from log.user_activity_view import view_my_activity
-            view_my_activity(user["username"])
-            st.stop()
-            
     # ===== MENU NGHIỆP VỤ (luôn có cho mọi user) =====
-    menu = st.selectbox(
-        "Chọn phân hệ",
-        [
-            "📘 Phôi Thẻ – GTCG",
-            "💸 Mục 09 – Chuyển tiền",
-            "📑 Tờ khai Hải quan",
-            "🏦 Tiêu chí tín dụng CRM4–32",
-            "💼 HDV (TC1 – TC3)",
-            "🌏 Ngoại tệ & Vàng (TC5 – TC6)",
-            "👥 DVKH (5 tiêu chí)",
-            "💳 Tiêu chí thẻ",
-            "💳 Tiêu chí máy pos",
-        ]
-    )
+    menu = st.selectbox("Chọn phân hệ", list(MENU_ACTIONS))
 
 
 # ============================================================
 # POPUP ĐỔI MẬT KHẨU (NẾU USER BẤM)
 # ============================================================
 if st.session_state.get("change_pw"):
+    from db.change_pw import change_password_popup
+
     change_password_popup()
     st.stop()
 
@@ -138,41 +195,12 @@ if st.session_state.get("change_pw"):
 # ============================================================
 st.title("📊 CHƯƠNG TRÌNH CHẠY TIÊU CHÍ CHỌN MẪU – KTNB")
 
-if menu == "📘 Phôi Thẻ – GTCG":
-    colored_header("📘 PHÔI THẺ – GTCG")
-    run_with_user_error(run_phoi_the, "xử lý Phôi Thẻ – GTCG")
-
-elif menu == "💸 Mục 09 – Chuyển tiền":
-    colored_header("💸 CHUYỂN TIỀN")
-    run_with_user_error(run_chuyen_tien, "xử lý Mục 09 – Chuyển tiền")
-
-elif menu == "📑 Tờ khai Hải quan":
-    colored_header("📑 TỜ KHAI HẢI QUAN")
-    run_with_user_error(run_to_khai_hq, "xử lý Tờ khai Hải quan")
-
-elif menu == "🏦 Tiêu chí tín dụng CRM4–32":
-    colored_header("🏦 TÍN DỤNG CRM4 – CRM32")
-    run_with_user_error(run_tin_dung, "xử lý Tiêu chí tín dụng CRM4–32")
-
-elif menu == "💼 HDV (TC1 – TC3)":
-    colored_header("💼 HDV – TC1 đến TC3")
-    run_with_user_error(run_hdv, "xử lý HDV (TC1 – TC3)")
-
-elif menu == "🌏 Ngoại tệ & Vàng (TC5 – TC6)":
-    colored_header("🌏 NGOẠI TỆ & VÀNG")
-    run_with_user_error(run_ngoai_te_vang, "xử lý Ngoại tệ & Vàng")
-
-elif menu == "👥 DVKH (5 tiêu chí)":
-    colored_header("👥 DVKH – 5 TIÊU CHÍ")
-    run_with_user_error(run_dvkh_5_tieuchi, "xử lý DVKH (5 tiêu chí)")
-
-elif menu == "💳 Tiêu chí thẻ":
-    colored_header("💳 TIÊU CHÍ THẺ")
-    run_with_user_error(run_module_the, "xử lý Tiêu chí Thẻ")
+# Kiểm tra quyền trước khi render header / import module nghiệp vụ
+allowed_roles = MENU_ROLES.get(menu)
+if allowed_roles and not require_role(user, allowed_roles):
+    st.error(f"🚫 Bạn không có quyền truy cập mục {menu}")
+    st.stop()
 
-elif menu == "💳 Tiêu chí máy pos":
-    if not require_role(user, ["admin", "pos","user"]):
-        st.error("🚫 Bạn không có quyền truy cập mục POS")
-        st.stop()
-    colored_header("💳 TIÊU CHÍ MÁY POS")
-    run_with_user_error(run_module_pos, "xử lý Tiêu chí máy POS")
+header_title, menu_action, menu_context = MENU_ACTIONS[menu]
+colored_header(header_title)
+run_with_user_error(menu_action, menu_context)
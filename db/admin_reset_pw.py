@@ -12,13 +12,16 @@ def admin_reset_password():
         st.info("Chưa có tài khoản nào trong hệ thống.")
         return
 
+    users_by_name = {u["username"]: u for u in users}
+
+    def _label(uname):
+        u = users_by_name.get(uname)
+        return f"{uname} — {u['full_name']} ({u['role']})" if u else uname
+
     selected = st.selectbox(
         "Chọn user:",
-        options=[u["username"] for u in users],
-        format_func=lambda uname: next(
-            (f"{uname} — {u['full_name']} ({u['role']})" for u in users if u["username"] == uname),
-            uname,
-        ),
+        options=list(users_by_name),
+        format_func=_label,
     )
 
     new_pw = st.text_input("Mật khẩu mới", type="password")
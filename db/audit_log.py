@@ -1,46 +1,65 @@
-import os
-import sqlite3
-from datetime import datetime
+import streamlit as st
 
-from db.auth_db import DB_PATH, init_db
+from db.auth_db import _DB_LOCK, get_conn
+
+
+# Bảng audit_log chỉ cần kiểm tra/tạo 1 lần cho mỗi process
+_TABLE_READY = False
 
 
 def _ensure_table():
-    init_db()
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS audit_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            username TEXT,
-            action TEXT
+    global _TABLE_READY
+    if _TABLE_READY:
+        return
+
+    conn = get_conn()
+    with _DB_LOCK:
+        c = conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')),
+                username TEXT,
+                action TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
+        c.execute("CREATE INDEX IF NOT EXISTS idx_audit_user_ts ON audit_log(username, timestamp DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit_log(timestamp DESC)")
+        conn.commit()
+    _TABLE_READY = True
 
 
-def log_action(action: str, username="admin"):
+def log_actions(actions, username="admin"):
+    """Ghi nhiều dòng audit trong 1 transaction (1 lần commit cho cả lô)."""
     _ensure_table()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO audit_log (timestamp, username, action) VALUES (?, ?, ?)",
-        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), username, action),
-    )
-    conn.commit()
-    conn.close()
+    rows = [(username, action) for action in actions]
+    if not rows:
+        return
+
+    # timestamp do SQLite tính (ghi rõ trong VALUES để bảng cũ không có DEFAULT vẫn đúng)
+    conn = get_conn()
+    with _DB_LOCK, conn:
+        conn.executemany(
+            "INSERT INTO audit_log (timestamp, username, action) "
+            "VALUES (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'), ?, ?)",
+            rows,
+        )
+    get_logs.clear()
+
+
+def log_action(action: str, username="admin"):
+    log_actions([action], username)
 
 
+@st.cache_data(ttl=30, show_spinner=False)
 def get_logs():
+    """Toàn bộ audit log (mới nhất trước); cache ngắn, xoá cache mỗi khi ghi log mới."""
     _ensure_table()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT timestamp, username, action FROM audit_log ORDER BY id DESC")
-    logs = c.fetchall()
-    conn.close()
+    conn = get_conn()
+    with _DB_LOCK:
+        c = conn.cursor()
+        c.execute("SELECT timestamp, username, action FROM audit_log ORDER BY id DESC")
+        logs = c.fetchall()
     return logs
@@ -1,17 +1,39 @@
 import os
 import sqlite3
+import threading
+
+import streamlit as st
 
 from db.security import hash_password, verify_password
 
 # 📌 Lưu database vào thư mục persistent của Streamlit Cloud
 DB_PATH = os.path.join(".streamlit", "users.db")
 
+# Kết nối được dùng chung giữa các thread script của Streamlit -> khoá khi truy cập
+_DB_LOCK = threading.RLock()
+
+# init_db() chỉ cần chạy 1 lần cho mỗi process
+_INITIALIZED = False
+
+
+def _apply_pragmas(conn):
+    """WAL + synchronous=NORMAL: ghi log/đổi mật khẩu không fsync mỗi câu lệnh."""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
 
 def init_db():
     """Tạo bảng user nếu chưa tồn tại"""
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+
     os.makedirs(".streamlit", exist_ok=True)
 
     conn = sqlite3.connect(DB_PATH)
+    _apply_pragmas(conn)
     c = conn.cursor()
 
     c.execute("""
@@ -22,17 +44,29 @@ def init_db():
             password_hash TEXT
         )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
 
     conn.commit()
     conn.close()
+    _INITIALIZED = True
+
+
+@st.cache_resource(show_spinner=False)
+def get_conn():
+    """Kết nối SQLite dùng chung cho cả process (mở 1 lần, không đóng sau mỗi truy vấn)."""
+    init_db()
+    # cached_statements: giữ sẵn câu lệnh đã parse (VD: get_user_by_username) giữa các lần gọi
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=128)
+    _apply_pragmas(conn)
+    return conn
 
 
 def get_user_by_username(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT username, full_name, role, password_hash FROM users WHERE username = ?", (username,))
-    row = c.fetchone()
-    conn.close()
+    conn = get_conn()
+    with _DB_LOCK:
+        c = conn.cursor()
+        c.execute("SELECT username, full_name, role, password_hash FROM users WHERE username = ?", (username,))
+        row = c.fetchone()
 
     if row:
         return {
@@ -58,60 +92,58 @@ def authenticate_user(username, password):
 
 
 def insert_user(username, full_name, role, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO users (username, full_name, role, password_hash) VALUES (?, ?, ?, ?)",
-        (username, full_name, role, hash_password(password)),
-    )
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    # with conn: commit khi thành công, rollback khi lỗi (kết nối dùng chung không bị treo transaction)
+    with _DB_LOCK, conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO users (username, full_name, role, password_hash) VALUES (?, ?, ?, ?)",
+            (username, full_name, role, hash_password(password)),
+        )
+    get_all_users.clear()
 
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_all_users():
     """Lấy toàn bộ user để hiển thị ở màn reset mật khẩu admin."""
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT username, full_name, role FROM users ORDER BY username ASC")
-    users = [
-        {"username": row[0], "full_name": row[1], "role": row[2]}
-        for row in c.fetchall()
-    ]
-    conn.close()
+    conn = get_conn()
+    with _DB_LOCK:
+        c = conn.cursor()
+        c.execute("SELECT username, full_name, role FROM users ORDER BY username ASC")
+        users = [
+            {"username": row[0], "full_name": row[1], "role": row[2]}
+            for row in c.fetchall()
+        ]
     return users
 
 #them
 def create_user(username, full_name, role, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    conn = get_conn()
+    with _DB_LOCK, conn:
+        c = conn.cursor()
 
-    # check trùng username
-    c.execute("SELECT 1 FROM users WHERE username=?", (username,))
-    if c.fetchone():
-        conn.close()
-        return False, "Username đã tồn tại!"
+        # check trùng username
+        c.execute("SELECT 1 FROM users WHERE username=?", (username,))
+        if c.fetchone():
+            return False, "Username đã tồn tại!"
 
-    hashed = hash_password(password)
+        hashed = hash_password(password)
 
-    c.execute(
-        "INSERT INTO users(username, full_name, role, password_hash) VALUES (?, ?, ?, ?)",
-        (username, full_name, role, hashed)
-    )
-    conn.commit()
-    conn.close()
+        c.execute(
+            "INSERT INTO users(username, full_name, role, password_hash) VALUES (?, ?, ?, ?)",
+            (username, full_name, role, hashed)
+        )
+    get_all_users.clear()
     return True, "Tạo user thành công!"
 def update_password(username, new_password):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "UPDATE users SET password_hash = ? WHERE username = ?",
-        (hash_password(new_password), username),
-    )
-    updated = c.rowcount
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    with _DB_LOCK, conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE users SET password_hash = ? WHERE username = ?",
+            (hash_password(new_password), username),
+        )
+        updated = c.rowcount
     return updated > 0
 
 # import sqlite3
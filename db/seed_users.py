@@ -1,26 +1,32 @@
-import sqlite3
-from db.auth_db import init_db, DB_PATH
+from db.auth_db import _DB_LOCK, get_all_users, get_conn
 from db.security import hash_password
 
+DEFAULT_USERS = [
+    ("admin", "Quản trị hệ thống", "admin", "123"),
+    ("pos01", "Nhân viên POS", "pos", "123"),
+    ("td01", "Nhân viên tín dụng", "credit", "123"),
+    ("tamtnt", "User01", "user", "123"),
+    ("viewer", "Khách xem", "view", "123"),
+]
+
+
 def seed_users():
-    init_db()
+    conn = get_conn()
+    with _DB_LOCK:
+        existing = {row[0] for row in conn.execute("SELECT username FROM users")}
 
+    # Chỉ hash mật khẩu cho user chưa có trong DB
     users = [
-        ("admin", "Quản trị hệ thống", "admin", hash_password("123")),
-        ("pos01", "Nhân viên POS", "pos", hash_password("123")),
-        ("td01", "Nhân viên tín dụng", "credit", hash_password("123")),
-        ("tamtnt", "User01", "user", hash_password("123")),
-        ("viewer", "Khách xem", "view", hash_password("123")),
+        (username, full_name, role, hash_password(password))
+        for username, full_name, role, password in DEFAULT_USERS
+        if username not in existing
     ]
+    if not users:
+        return
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-
-    for u in users:
-        try:
-            c.execute("INSERT INTO users VALUES (?,?,?,?)", u)
-        except:
-            pass
-
-    conn.commit()
-    conn.close()
+    with _DB_LOCK, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (username, full_name, role, password_hash) VALUES (?, ?, ?, ?)",
+            users,
+        )
+    get_all_users.clear()
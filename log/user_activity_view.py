@@ -1,23 +1,25 @@
+import pandas as pd
 import streamlit as st
 from db.user_logs import get_user_logs
 
 
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_user_logs(username):
+    """Cache kết quả truy vấn log theo username để rerun không truy vấn lại DB."""
+    return get_user_logs(username)
+
+
 def view_my_activity(username):
     """Hiển thị lịch sử hoạt động của chính user đang đăng nhập"""
 
     st.subheader("🧾 Lịch sử hoạt động của bạn")
 
-    user_logs = get_user_logs(username)
+    user_logs = _cached_user_logs(username)
 
     if not user_logs:
         st.info("⛔ Bạn chưa có hoạt động nào được ghi lại.")
         return
 
     # Hiển thị dạng bảng
-    st.table(
-        {
-            "Người dùng": [log[0] for log in user_logs],
-            "Hoạt động": [log[1] for log in user_logs],
-            "Thời gian": [log[2] for log in user_logs],
-        }
-    )
+    df = pd.DataFrame(user_logs, columns=["Người dùng", "Hoạt động", "Thời gian"])
+    st.dataframe(df, use_container_width=True)
@@ -7,8 +7,8 @@ Bao gồm:
 
 Tính năng:
 - Hỗ trợ upload đơn file Excel hoặc ZIP (với nhiều Excel bên trong) cho CKH/KKH, SMS zip chứa .txt.
-- Audit log vào dvkh_audit.csv (append).
-- Xuất Excel nhiều sheet (ví dụ: Tieu_chi_4 + Tieu_chi_5).
+- Audit log vào dvkh_audit.jsonl (append, mỗi dòng 1 JSON).
+- Xuất Excel nhiều sheet (ví dụ: Tieu_chi_4 + Tieu_chi_5), kèm bản Parquet (ZIP) nếu có pyarrow.
 """
 
 import streamlit as st
@@ -16,12 +16,28 @@ import pandas as pd
 import numpy as np
 import io
 import re
+import csv
+import json
 import zipfile
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Optional, Tuple
+from typing import IO, List, Optional, Tuple
+
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 from module.error_utils import UserFacingError, _should_reraise
+from module.excel_utils import excel_bytes, read_excel_calamine
+
+# pyarrow (đi kèm streamlit) dùng để đọc file text nhanh; không có thì dùng pandas
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.json as pajson
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pacsv = pajson = pq = None
 
 # Cố gắng lấy user hiện tại từ hệ thống auth (nếu project của bạn có)
 try:
@@ -34,66 +50,250 @@ except Exception:
 # ---------------------------
 # Cấu hình & Audit
 # ---------------------------
-AUDIT_FILE = "dvkh_audit.csv"
+AUDIT_FILE = "dvkh_audit.jsonl"
+# file CSV của phiên bản cũ, vẫn được đọc để hiển thị
+LEGACY_AUDIT_FILE = "dvkh_audit.csv"
+AUDIT_COLUMNS = ["timestamp", "username", "action", "note"]
+
+_audit_fh = None
+_AUDIT_LOCK = threading.Lock()
 
 
 def audit_log(action: str, note: str = "", user: Optional[dict] = None):
-    """Ghi log hoạt động (append CSV)."""
+    """Ghi log hoạt động: mỗi dòng 1 JSON, append qua file handle mở 1 lần."""
+    global _audit_fh
     ts = datetime.now().isoformat(sep=" ", timespec="seconds")
     if user is None:
         user = get_current_user() if callable(get_current_user) else {"username": "unknown"}
     username = user.get("username", "unknown") if isinstance(user, dict) else str(user)
     row = {"timestamp": ts, "username": username, "action": action, "note": note}
-    df_row = pd.DataFrame([row])
-    header = not os.path.exists(AUDIT_FILE)
-    df_row.to_csv(AUDIT_FILE, mode="a", header=header, index=False, encoding="utf-8-sig")
+    line = (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+    with _AUDIT_LOCK:
+        if _audit_fh is None or _audit_fh.closed:
+            # không buffer: mỗi dòng là 1 lần write (O_APPEND) -> xuống đĩa ngay và nguyên vẹn,
+            # không mất log khi worker bị kill, không xen dòng khi nhiều process cùng ghi
+            _audit_fh = open(AUDIT_FILE, "ab", buffering=0)
+        _audit_fh.write(line)
+
+
+def read_audit_log() -> pd.DataFrame:
+    """Đọc toàn bộ audit (CSV cũ + JSONL) thành DataFrame để hiển thị / xuất CSV."""
+    frames = []
+    if os.path.exists(LEGACY_AUDIT_FILE):
+        frames.append(pd.read_csv(LEGACY_AUDIT_FILE, dtype=str, encoding="utf-8-sig"))
+    if os.path.exists(AUDIT_FILE) and os.path.getsize(AUDIT_FILE) > 0:
+        if pajson is not None:
+            # pyarrow đọc JSONL đa luồng, dạng cột, đúng 4 cột chuỗi
+            schema = pa.schema([(c, pa.string()) for c in AUDIT_COLUMNS])
+            table = pajson.read_json(
+                AUDIT_FILE,
+                parse_options=pajson.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore"),
+            )
+            frames.append(table.to_pandas())
+        else:
+            frames.append(pd.read_json(AUDIT_FILE, lines=True, dtype=False))
+    if not frames:
+        return pd.DataFrame(columns=AUDIT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _mtime(path: str) -> float:
+    return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+
+def _read_last_lines(path: str, n: int = 200, chunk: int = 262144) -> List[bytes]:
+    """Lấy n dòng cuối (không rỗng) của file, chỉ đọc tối đa `chunk` bytes ở cuối file"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - chunk))
+        data = f.read()
+    lines = data.split(b"\n")
+    if size > chunk:
+        # dòng đầu của đoạn đọc có thể bị cắt dở
+        lines = lines[1:]
+    return [line for line in lines if line.strip()][-n:]
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def read_audit_tail(n: int = 200, mtime: float = 0.0, legacy_mtime: float = 0.0) -> pd.DataFrame:
+    """n dòng audit mới nhất (mới nhất lên đầu); mtime chỉ dùng làm khóa cache"""
+    frames = []
+    if os.path.exists(AUDIT_FILE) and os.path.getsize(AUDIT_FILE) > 0:
+        tail = _read_last_lines(AUDIT_FILE, n)
+        if tail:
+            frames.append(pd.read_json(io.BytesIO(b"\n".join(tail)), lines=True, dtype=False))
+    so_dong = sum(len(df) for df in frames)
+    if so_dong < n and os.path.exists(LEGACY_AUDIT_FILE):
+        # file CSV cũ không còn ghi thêm; ghi chú có thể nhiều dòng nên đọc bằng read_csv
+        legacy = pd.read_csv(LEGACY_AUDIT_FILE, dtype=str, encoding="utf-8-sig")
+        frames.insert(0, legacy.tail(n - so_dong))
+    if not frames:
+        return pd.DataFrame(columns=AUDIT_COLUMNS)
+    # nhiều process cùng append (mỗi process 1 buffer riêng) -> thứ tự dòng có thể lệch nhẹ:
+    # lấy top-n theo timestamp (datetime64) bằng nlargest thay cho sort toàn bộ;
+    # đảo ngược trước để các dòng cùng giây vẫn giữ dòng ghi sau lên trước
+    df = pd.concat(frames, ignore_index=True).iloc[::-1]
+    ts = pd.to_datetime(df["timestamp"], format="ISO8601", errors="coerce").fillna(pd.Timestamp.min)
+    return df.loc[ts.nlargest(n, keep="first").index].reset_index(drop=True)
 
 
 # ---------------------------
 # Utilities đọc/ghi
 # ---------------------------
 @st.cache_data(show_spinner=False)
-def read_excel_file_bytesio(uploaded_file) -> pd.DataFrame:
+def _read_excel_bytes(name: str, raw: bytes, usecols: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+    """Parse Excel từ bytes; cache theo (tên file, nội dung, cột cần đọc) để rerun không parse lại"""
+    # usecols: chỉ giữ các cột có tên trong danh sách (cột thiếu không gây lỗi)
+    cols = None if usecols is None else (lambda c: c in usecols)
+    return read_excel_calamine(raw, dtype=str, usecols=cols)
+
+
+def _to_bytes(f) -> bytes:
+    """Lấy toàn bộ nội dung file (UploadedFile / BytesIO / file handle / bytes)"""
+    if hasattr(f, "getvalue"):
+        return f.getvalue()
+    if hasattr(f, "read"):
+        return f.read()
+    return f
+
+
+def read_excel_file_bytesio(uploaded_file, usecols: Optional[List[str]] = None) -> pd.DataFrame:
     """Đọc file Excel từ UploadedFile / BytesIO; trả DataFrame dtype=str"""
-    # streamlit uploaded_file has .read() but pandas accepts file-like; pass-through
-    try:
-        return pd.read_excel(uploaded_file, dtype=str)
-    except Exception as e:
-        # thử read bằng io.BytesIO nếu uploaded_file là UploadedFile và đã được .read() trước
+    # dtype=str: mọi cột đã là chuỗi ngay khi đọc (pandas >= 3 + pyarrow: lưu dạng Arrow),
+    # các bước lọc phía sau dùng .str trực tiếp, không astype(str) lại
+    # lấy bytes 1 lần (getvalue không phụ thuộc vị trí con trỏ), luôn parse từ BytesIO(raw)
+    raw = _to_bytes(uploaded_file)
+    return _read_excel_bytes(
+        getattr(uploaded_file, "name", ""), raw, tuple(usecols) if usecols is not None else None
+    )
+
+
+def _read_excel_item(f, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """f có thể là UploadedFile / BytesIO hoặc tuple (name, file handle) lấy từ zip"""
+    if isinstance(f, tuple) and hasattr(f[1], "read"):
+        return read_excel_file_bytesio(f[1], usecols)
+    return read_excel_file_bytesio(f, usecols)
+
+
+def read_excel_files(files: List, usecols: Optional[List[str]] = None) -> List[pd.DataFrame]:
+    """Đọc nhiều file Excel song song bằng thread pool; giữ nguyên thứ tự file"""
+    files = list(files or [])
+    if len(files) <= 1:
+        return [_read_excel_item(f, usecols) for f in files]
+    # số luồng theo số file và số CPU (tối đa 8 để giới hạn bộ nhớ khi nhiều file cùng parse)
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1, 8)) as ex:
+        return list(ex.map(lambda f: _read_excel_item(f, usecols), files))
+
+
+def _read_text_pyarrow(src, sep: str) -> pd.DataFrame:
+    """Đọc file text bằng pyarrow.csv (đa luồng); mọi cột giữ dạng chuỗi như dtype=str"""
+    header = src.readline().decode("utf-8-sig")
+    src.seek(0)
+    # tách tiêu đề theo đúng quy tắc CSV (tên cột trong ngoặc kép có thể chứa dấu phân cách)
+    names = next(csv.reader([header], delimiter=sep), [])
+    # tên cột trùng/rỗng: pandas tự đổi tên (A.1, Unnamed: n) -> để pandas đọc
+    if not names or "" in names or len(set(names)) != len(names):
+        raise ValueError("Tiêu đề có cột trùng hoặc rỗng")
+    table = pacsv.read_csv(
+        src,
+        # dòng thừa cột: bỏ qua (như on_bad_lines="skip"); dòng thiếu cột: báo lỗi để
+        # quay về pandas (pandas giữ dòng đó và điền NaN)
+        parse_options=pacsv.ParseOptions(
+            delimiter=sep,
+            invalid_row_handler=lambda row: "skip" if row.actual_columns > row.expected_columns else "error",
+        ),
+        convert_options=pacsv.ConvertOptions(
+            column_types={n: pa.string() for n in names},
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas()
+    # mọi cột phải là chuỗi như dtype=str (giữ số 0 đầu); không thì để pandas đọc
+    if list(df.columns) != names or not all(pd.api.types.is_string_dtype(t) for t in df.dtypes):
+        raise ValueError("Kết quả pyarrow khác kiểu chuỗi")
+    return df
+
+
+def read_text_file_bytesio(uploaded_file, sep: str = "\t") -> pd.DataFrame:
+    """Đọc file text (tab-separated) từ UploadedFile / BytesIO / bytes"""
+    raw = _to_bytes(uploaded_file)
+    if pacsv is not None:
         try:
-            raw = uploaded_file.read()
-            return pd.read_excel(io.BytesIO(raw), dtype=str)
+            return _read_text_pyarrow(io.BytesIO(raw), sep)
         except Exception:
-            raise
+            pass
+    return pd.read_csv(io.BytesIO(raw), sep=sep, dtype=str, on_bad_lines="skip")
 
 
 @st.cache_data(show_spinner=False)
-def read_text_file_bytesio(uploaded_file, sep: str = "\t") -> pd.DataFrame:
-    """Đọc file text (tab-separated) từ UploadedFile / BytesIO"""
+def build_sms_set(raw: bytes) -> frozenset:
+    """Tập FORACID (TK dạng số, loại KHDN) có đăng ký SMS; cache theo nội dung file"""
+    df_sms = read_text_file_bytesio(raw)
+    if "FORACID" not in df_sms.columns:
+        return frozenset()
+    foracid = df_sms["FORACID"]
+    mask = foracid.str.match(r"^\d+$", na=False)
+    if "CUSTTPCD" in df_sms.columns:
+        mask &= df_sms["CUSTTPCD"].str.upper() != "KHDN"
+    return frozenset(foracid[mask])
+
+
+@st.cache_data(show_spinner=False)
+def build_scm10_set(raw: bytes) -> frozenset:
+    """Tập CIF có đăng ký SCM010; cache theo nội dung file"""
     try:
-        return pd.read_csv(uploaded_file, sep=sep, dtype=str, on_bad_lines="skip")
+        df_scm10 = read_excel_file_bytesio(raw)
+        df_scm10 = df_scm10.rename(columns=lambda x: x.strip())
     except Exception:
-        try:
-            raw = uploaded_file.read()
-            return pd.read_csv(io.BytesIO(raw), sep=sep, dtype=str, on_bad_lines="skip")
-        except Exception:
-            raise
+        return frozenset()
+    if "CIF_ID" not in df_scm10.columns:
+        return frozenset()
+    return frozenset(df_scm10["CIF_ID"].dropna())
 
 
 def safe_to_datetime(series):
     return pd.to_datetime(series, errors="coerce")
 
 
-def to_excel_bytes(dfs: dict) -> bytes:
+def to_parquet_zip_bytes(dfs: dict) -> Optional[bytes]:
+    """
+    Mỗi sheet -> 1 file .parquet (zstd) trong 1 ZIP; ghi nhanh hơn xlsx nhiều lần.
+    Trả về None nếu không có pyarrow hoặc có cột không chuyển được sang Arrow.
+    """
+    if pq is None:
+        return None
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        for name, df in dfs.items():
-            sheet = name[:31]
-            df.to_excel(writer, sheet_name=sheet, index=False)
-    output.seek(0)
+    try:
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as z:
+            for name, df in dfs.items():
+                buf = io.BytesIO()
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buf, compression="zstd")
+                z.writestr(f"{name}.parquet", buf.getvalue())
+    except (pa.ArrowException, ValueError, TypeError):
+        return None
     return output.getvalue()
 
 
+def concat_columns(frames: List[pd.DataFrame], cols: List[str]) -> pd.DataFrame:
+    """
+    Ghép dọc nhiều DataFrame, chỉ lấy các cột trong cols: mỗi cột 1 lần np.concatenate.
+    File thiếu cột -> NaN cho các dòng của file đó (như pd.concat);
+    cột không có ở file nào thì bỏ qua (ensure_columns bổ sung sau).
+    """
+    if not frames:
+        return pd.DataFrame()
+    data = {}
+    for c in cols:
+        if not any(c in df.columns for df in frames):
+            continue
+        data[c] = np.concatenate([
+            df[c].to_numpy(dtype=object) if c in df.columns else np.full(len(df), np.nan, dtype=object)
+            for df in frames
+        ])
+    return pd.DataFrame(data)
+
+
 def ensure_columns(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
     for c in cols:
         if c not in df.columns:
@@ -104,33 +304,35 @@ def ensure_columns(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
 # ---------------------------
 # ZIP helpers
 # ---------------------------
-def extract_excel_from_zip_bytes(zip_uploaded) -> List[Tuple[str, io.BytesIO]]:
+def extract_excel_from_zip_bytes(zip_uploaded) -> List[Tuple[str, IO[bytes]]]:
     """
-    Trả về list các tuple (filename, BytesIO) của file xls/xlsx trong zip_uploaded.
-    zip_uploaded: streamlit UploadedFile hoặc BytesIO
+    Trả về list các tuple (filename, file handle) của file xls/xlsx trong zip_uploaded.
+    zip_uploaded: streamlit UploadedFile hoặc BytesIO (seekable) hoặc bytes
+    Mỗi handle là ZipExtFile: giải nén khi đọc, không copy cả zip / từng file ra BytesIO.
     """
     try:
-        raw = zip_uploaded.read() if hasattr(zip_uploaded, "read") else zip_uploaded
-        z = zipfile.ZipFile(io.BytesIO(raw))
-        res = []
-        for name in z.namelist():
-            if name.lower().endswith((".xls", ".xlsx")):
-                res.append((name, io.BytesIO(z.read(name))))
-        return res
+        src = zip_uploaded if hasattr(zip_uploaded, "read") else io.BytesIO(zip_uploaded)
+        z = zipfile.ZipFile(src)
+        return [
+            (name, z.open(name))
+            for name in z.namelist()
+            if name.lower().endswith((".xls", ".xlsx"))
+        ]
     except Exception:
         return []
 
 
-def extract_text_from_zip_bytes(zip_uploaded) -> Tuple[Optional[io.BytesIO], Optional[str]]:
+def extract_text_from_zip_bytes(zip_uploaded) -> Tuple[Optional[IO[bytes]], Optional[str]]:
     """
-    Trả về (BytesIO, filename) của file .txt đầu tiên trong zip.
+    Trả về (file handle, filename) của file .txt đầu tiên trong zip.
+    Handle là ZipExtFile: chỉ giải nén 1 lần khi đọc, không copy zip / txt ra BytesIO.
     """
     try:
-        raw = zip_uploaded.read() if hasattr(zip_uploaded, "read") else zip_uploaded
-        z = zipfile.ZipFile(io.BytesIO(raw))
+        src = zip_uploaded if hasattr(zip_uploaded, "read") else io.BytesIO(zip_uploaded)
+        z = zipfile.ZipFile(src)
         for name in z.namelist():
             if name.lower().endswith(".txt"):
-                return io.BytesIO(z.read(name)), name
+                return z.open(name), name
         return None, None
     except Exception:
         return None, None
@@ -139,6 +341,16 @@ def extract_text_from_zip_bytes(zip_uploaded) -> Tuple[Optional[io.BytesIO], Opt
 # ---------------------------
 # XỬ LÝ TIÊU CHÍ 1-3 (Ủy quyền + SMS + SCM010)
 # ---------------------------
+# Đoạn tên IN HOA (>= 3 ký tự) nằm giữa các dấu '-' / ','
+_TEN_IN_HOA_PAT = re.compile(r"(?:^|[-,])\s*([A-Z][A-Z ]+[A-Z])\s*(?=[-,]|$)")
+# Người ủy quyền là doanh nghiệp: CONG TY / CONGTY / CÔNG TY / CÔNGTY / CTY
+_DN_PAT = re.compile(r"C[ÔO]NG ?TY|CTY", re.IGNORECASE)
+# DESCRIPTION có "chu ky" / "chuky" / "cky" (chu\s*ky đã bao "chuky")
+_CHU_KY_PAT = re.compile(r"chu\s*ky|cky", re.IGNORECASE)
+# Loại TK không hợp lệ cho tiêu chí 4
+_EXCL_SCHM_PAT = re.compile(r"KY QUY|GIAI NGAN|CHI LUONG|TKTT THE|TRUNG GIAN", re.IGNORECASE)
+
+
 def process_uyquyen_sms_scm(
     uploaded_ckh_files: List,
     uploaded_kkh_files: List,
@@ -157,41 +369,27 @@ def process_uyquyen_sms_scm(
     # --- 1. Ghép CKH + KKH ---
     df_b_CKH = pd.DataFrame()
     df_b_KKH = pd.DataFrame()
+    # chỉ IDXACNO / CUSTSEQ được dùng phía sau -> chỉ ghép 2 cột này
+    cols_b = ["IDXACNO", "CUSTSEQ"]
+
     if uploaded_ckh_files:
-        frames = []
-        for f in uploaded_ckh_files:
-            # f may be UploadedFile or (name, BytesIO)
-            try:
-                frames.append(read_excel_file_bytesio(f))
-            except Exception:
-                # nếu f là tuple (name, BytesIO)
-                if isinstance(f, tuple) and hasattr(f[1], "read"):
-                    frames.append(read_excel_file_bytesio(f[1]))
-                else:
-                    raise
+        # f may be UploadedFile or (name, file handle)
+        frames = read_excel_files(uploaded_ckh_files)
         if frames:
-            df_b_CKH = pd.concat(frames, ignore_index=True)
+            df_b_CKH = concat_columns(frames, cols_b)
 
     if uploaded_kkh_files:
-        frames = []
-        for f in uploaded_kkh_files:
-            try:
-                frames.append(read_excel_file_bytesio(f))
-            except Exception:
-                if isinstance(f, tuple) and hasattr(f[1], "read"):
-                    frames.append(read_excel_file_bytesio(f[1]))
-                else:
-                    raise
+        frames = read_excel_files(uploaded_kkh_files)
         if frames:
-            df_b_KKH = pd.concat(frames, ignore_index=True)
+            df_b_KKH = concat_columns(frames, cols_b)
 
     # df_b combine
     if not df_b_CKH.empty and not df_b_KKH.empty:
         df_b = pd.concat([df_b_CKH, df_b_KKH], ignore_index=True)
     elif not df_b_CKH.empty:
-        df_b = df_b_CKH.copy()
+        df_b = df_b_CKH
     elif not df_b_KKH.empty:
-        df_b = df_b_KKH.copy()
+        df_b = df_b_KKH
     else:
         df_b = pd.DataFrame()
 
@@ -199,29 +397,21 @@ def process_uyquyen_sms_scm(
     df_a = read_excel_file_bytesio(uploaded_muc30_file)
 
     # lọc DESCRIPTION chứa chu ky
-    df_a = df_a[df_a.get("DESCRIPTION", "").astype(str).str.contains(r"chu\s*ky|chuky|cky", case=False, na=False)].copy()
+    df_a = df_a[df_a.get("DESCRIPTION", "").str.contains(_CHU_KY_PAT, na=False)].copy()
 
-    # parse ngày an toàn
+    # parse ngày an toàn (1 lần; giữ cả _dt và _str)
     df_a["EXPIRYDATE_dt"] = safe_to_datetime(df_a.get("EXPIRYDATE", pd.Series(dtype=str)))
     df_a["EFFECTIVEDATE_dt"] = safe_to_datetime(df_a.get("EFFECTIVEDATE", pd.Series(dtype=str)))
     df_a["EXPIRYDATE_str"] = df_a["EXPIRYDATE_dt"].dt.strftime("%m/%d/%Y")
     df_a["EFFECTIVEDATE_str"] = df_a["EFFECTIVEDATE_dt"].dt.strftime("%m/%d/%Y")
 
     # loại doanh nghiệp
-    keywords = ["CONG TY", "CTY", "CONGTY", "CÔNG TY", "CÔNGTY"]
-    df_a = df_a[~df_a.get("NGUOI_UY_QUYEN", "").astype(str).str.upper().str.contains("|".join(keywords), na=False)].copy()
-
-    # tách NGUOI_DUOC_UY_QUYEN
-    def extract_name(value):
-        parts = re.split(r"[-,]", str(value))
-        for part in parts:
-            name = part.strip()
-            if re.fullmatch(r"[A-Z ]{3,}", name):
-                return name
-        return value
+    df_a = df_a[~df_a.get("NGUOI_UY_QUYEN", "").str.contains(_DN_PAT, na=False)].copy()
 
+    # tách NGUOI_DUOC_UY_QUYEN: lấy đoạn IN HOA đầu tiên, không có thì giữ nguyên
     if "NGUOI_DUOC_UY_QUYEN" in df_a.columns:
-        df_a["NGUOI_DUOC_UY_QUYEN"] = df_a["NGUOI_DUOC_UY_QUYEN"].apply(extract_name)
+        ten = df_a["NGUOI_DUOC_UY_QUYEN"]
+        df_a["NGUOI_DUOC_UY_QUYEN"] = ten.str.extract(_TEN_IN_HOA_PAT, expand=False).fillna(ten)
     else:
         df_a["NGUOI_DUOC_UY_QUYEN"] = ""
 
@@ -230,44 +420,32 @@ def process_uyquyen_sms_scm(
     if dedup_cols:
         df_a = df_a.drop_duplicates(subset=dedup_cols, keep="first")
 
-    # --- 3. Merge TK_DUOC_UY_QUYEN vs df_b IDXACNO -> get CUSTSEQ (CIF) ---
-    if not df_b.empty and "IDXACNO" in df_b.columns and "TK_DUOC_UY_QUYEN" in df_a.columns:
-        df_a["TK_DUOC_UY_QUYEN"] = df_a["TK_DUOC_UY_QUYEN"].astype(str)
-        df_b["IDXACNO"] = df_b["IDXACNO"].astype(str)
-        merged = df_a.merge(df_b[["IDXACNO", "CUSTSEQ"]], left_on="TK_DUOC_UY_QUYEN", right_on="IDXACNO", how="left")
+    # --- 3. Tra TK_DUOC_UY_QUYEN vs df_b IDXACNO -> get CUSTSEQ (CIF) ---
+    # các cột khóa đã là chuỗi từ lúc đọc (dtype=str / concat_columns) -> không astype(str) lại
+    # bảng IDXACNO -> CUSTSEQ index 1 lần (mỗi TK 1 dòng), tra bằng map thay cho merge:
+    # không nhân dòng MUC30 khi 1 TK xuất hiện ở nhiều file CKH/KKH
+    merged = df_a.copy()
+    if not df_b.empty and "IDXACNO" in df_b.columns and "CUSTSEQ" in df_b.columns and "TK_DUOC_UY_QUYEN" in df_a.columns:
+        cif_theo_tk = df_b.drop_duplicates("IDXACNO").set_index("IDXACNO")["CUSTSEQ"]
+        merged["CUSTSEQ"] = merged["TK_DUOC_UY_QUYEN"].map(cif_theo_tk)
     else:
-        merged = df_a.copy()
         merged["CUSTSEQ"] = np.nan
 
-    # CIF người ủy quyền => string (or 'NA')
-    def norm_custseq(x):
-        try:
-            if pd.isna(x):
-                return "NA"
-            sx = str(x).strip()
-            if sx == "" or sx.lower() == "nan":
-                return "NA"
-            # convert floats like '123.0' -> '123'
-            if re.match(r"^\d+(\.0+)?$", sx):
-                return str(int(float(sx)))
-            return sx
-        except:
-            return "NA"
-
-    merged["CIF_NGUOI_UY_QUYEN"] = merged.get("CUSTSEQ", pd.Series(dtype=str)).apply(norm_custseq)
+    # CIF người ủy quyền => string (or 'NA'), xử lý vector hóa thay cho apply từng dòng
+    s = merged.get("CUSTSEQ", pd.Series(index=merged.index, dtype="string")).astype("string").str.strip()
+    na = s.isna() | s.eq("") | s.str.lower().eq("nan")
+    # convert floats like '123.0' -> '123'
+    num_mask = s.str.fullmatch(r"\d+(\.0+)?", na=False)
+    out = s.copy()
+    out[num_mask] = pd.to_numeric(s[num_mask], errors="coerce").astype("Int64").astype("string")
+    merged["CIF_NGUOI_UY_QUYEN"] = out.mask(na.fillna(True), "NA")
 
     # Bổ sung CIF nếu cùng NGUOI_UY_QUYEN
-    cif_updated = merged["CIF_NGUOI_UY_QUYEN"].copy()
     if "NGUOI_UY_QUYEN" in merged.columns:
-        for nguoi, group in merged.groupby("NGUOI_UY_QUYEN"):
-            if len(group) >= 2:
-                vals = group["CIF_NGUOI_UY_QUYEN"].unique().tolist()
-                actuals = [v for v in vals if v != "NA"]
-                if actuals:
-                    fill = actuals[0]
-                    idxs = group[group["CIF_NGUOI_UY_QUYEN"] == "NA"].index
-                    cif_updated.loc[idxs] = fill
-    merged["CIF_NGUOI_UY_QUYEN"] = cif_updated
+        # lấy CIF thực đầu tiên (khác 'NA') của từng nhóm, điền cho các dòng 'NA'
+        is_na = merged["CIF_NGUOI_UY_QUYEN"].eq("NA")
+        fill = merged["CIF_NGUOI_UY_QUYEN"].mask(is_na).groupby(merged["NGUOI_UY_QUYEN"]).transform("first")
+        merged["CIF_NGUOI_UY_QUYEN"] = merged["CIF_NGUOI_UY_QUYEN"].mask(is_na & fill.notna(), fill)
 
     # remove helper cols if exist
     for c in ["IDXACNO", "CUSTSEQ"]:
@@ -275,22 +453,14 @@ def process_uyquyen_sms_scm(
             merged.drop(columns=[c], inplace=True, errors="ignore")
 
     # classify account type using CKH/KKH sets
-    set_ckh = set(df_b_CKH["CUSTSEQ"].astype(str).dropna()) if not df_b_CKH.empty and "CUSTSEQ" in df_b_CKH.columns else set()
-    set_kkh = set(df_b_KKH["IDXACNO"].astype(str).dropna()) if not df_b_KKH.empty and "IDXACNO" in df_b_KKH.columns else set()
-
-    def phan_loai_tk(tk):
-        s = str(tk)
-        if s in set_ckh:
-            return "CKH"
-        if s in set_kkh:
-            return "KKH"
-        return "NA"
-
-    merged["LOAI_TK"] = merged.get("TK_DUOC_UY_QUYEN", pd.Series(dtype=str)).astype(str).apply(phan_loai_tk)
-
-    # time calculations
-    merged["EXPIRYDATE_dt"] = safe_to_datetime(merged.get("EXPIRYDATE_str") if "EXPIRYDATE_str" in merged.columns else merged.get("EXPIRYDATE"))
-    merged["EFFECTIVEDATE_dt"] = safe_to_datetime(merged.get("EFFECTIVEDATE_str") if "EFFECTIVEDATE_str" in merged.columns else merged.get("EFFECTIVEDATE"))
+    # pd.Index (hashtable dựng trong C) thay cho set Python
+    idx_ckh = pd.Index(df_b_CKH["CUSTSEQ"].dropna().unique()) if not df_b_CKH.empty and "CUSTSEQ" in df_b_CKH.columns else pd.Index([], dtype=str)
+    idx_kkh = pd.Index(df_b_KKH["IDXACNO"].dropna().unique()) if not df_b_KKH.empty and "IDXACNO" in df_b_KKH.columns else pd.Index([], dtype=str)
+
+    tk = merged.get("TK_DUOC_UY_QUYEN", pd.Series(index=merged.index, dtype=str))
+    merged["LOAI_TK"] = np.select([tk.isin(idx_ckh), tk.isin(idx_kkh)], ["CKH", "KKH"], default="NA")
+
+    # time calculations (dùng lại cột _dt đã parse ở bước 2, không parse lại từ chuỗi _str)
     merged["YEAR_DIFF"] = merged["EXPIRYDATE_dt"].dt.year - merged["EFFECTIVEDATE_dt"].dt.year
     merged["KHONG_NHAP_TGIAN_UQ"] = ""
     merged.loc[merged["YEAR_DIFF"].fillna(-1) == 99, "KHONG_NHAP_TGIAN_UQ"] = "X"
@@ -299,84 +469,20 @@ def process_uyquyen_sms_scm(
     merged.drop(columns=["EXPIRYDATE_dt", "EFFECTIVEDATE_dt", "YEAR_DIFF"], inplace=True, errors="ignore")
 
     # --- 4. SMS + SCM010 ---
-    # uploaded_sms_txt_file may be BytesIO or UploadedFile or BytesIO from zip
-    if uploaded_sms_txt_file is None:
-        df_sms_raw = pd.DataFrame()
-    else:
-        # If uploaded_sms_txt_file is BytesIO -> pass through read_text_file_bytesio
-        if isinstance(uploaded_sms_txt_file, io.BytesIO):
-            df_sms_raw = read_text_file_bytesio(uploaded_sms_txt_file)
-        else:
-            # if it's UploadedFile or other
-            try:
-                df_sms_raw = read_text_file_bytesio(uploaded_sms_txt_file)
-            except Exception:
-                # try reading bytes then parse
-                try:
-                    raw = uploaded_sms_txt_file.read()
-                    df_sms_raw = read_text_file_bytesio(io.BytesIO(raw))
-                except Exception:
-                    df_sms_raw = pd.DataFrame()
-
-    df_sms = df_sms_raw.copy() if not df_sms_raw.empty else pd.DataFrame()
-    # normalize columns used
-    for col in ["FORACID", "ORGKEY", "C_MOBILE_NO", "CRE_DATE", "CUSTTPCD"]:
-        if col in df_sms.columns:
-            df_sms[col] = df_sms[col].astype(str)
-
-    if "CRE_DATE" in df_sms.columns:
-        df_sms["CRE_DATE_parsed"] = safe_to_datetime(df_sms["CRE_DATE"])
-        df_sms["CRE_DATE_str"] = df_sms["CRE_DATE_parsed"].dt.strftime("%m/%d/%Y")
-
-    # filter by FORACID numeric and KHDN
-    if "FORACID" in df_sms.columns:
-        df_sms = df_sms[df_sms["FORACID"].str.match(r"^\d+$", na=False)]
-    if "CUSTTPCD" in df_sms.columns:
-        df_sms = df_sms[df_sms["CUSTTPCD"].astype(str).str.upper() != "KHDN"]
-
-    # SCM010
-    df_scm10 = pd.DataFrame()
-    try:
-        df_scm10 = read_excel_file_bytesio(uploaded_scm10_xlsx_file)
-        df_scm10 = df_scm10.rename(columns=lambda x: x.strip())
-    except Exception:
-        df_scm10 = pd.DataFrame()
-
-    if "CIF_ID" in df_scm10.columns:
-        df_scm10["CIF_ID"] = df_scm10["CIF_ID"].astype(str)
-
-    # combine
-    if not df_sms.empty:
-        df_sms["PL DICH VU"] = "SMS"
-    if not df_scm10.empty:
-        df_scm10["ORGKEY"] = df_scm10.get("CIF_ID", pd.Series(dtype=str))
-        df_scm10["PL DICH VU"] = "SCM010"
-
-    if not df_sms.empty and not df_scm10.empty:
-        df_merged_sms_scm10 = pd.concat([df_sms, df_scm10[["ORGKEY", "PL DICH VU"]].drop_duplicates()], ignore_index=True, axis=0)
-    elif not df_sms.empty:
-        df_merged_sms_scm10 = df_sms.copy()
-    elif not df_scm10.empty:
-        df_merged_sms_scm10 = df_scm10.copy()
-    else:
-        df_merged_sms_scm10 = pd.DataFrame()
+    # uploaded_sms_txt_file may be BytesIO, UploadedFile or the ZipExtFile handle from the SMS zip
+    # tập TK/CIF được cache theo nội dung file: rerun không lọc / ghép lại
+    tk_sms_set = build_sms_set(_to_bytes(uploaded_sms_txt_file)) if uploaded_sms_txt_file is not None else frozenset()
+    cif_scm10_set = build_scm10_set(_to_bytes(uploaded_scm10_xlsx_file)) if uploaded_scm10_xlsx_file is not None else frozenset()
 
-    df_sms_only = df_merged_sms_scm10[df_merged_sms_scm10.get("PL DICH VU", "") == "SMS"] if not df_merged_sms_scm10.empty else pd.DataFrame()
-    tk_sms_set = set(df_sms_only["FORACID"].astype(str).dropna()) if not df_sms_only.empty and "FORACID" in df_sms_only.columns else set()
-
-    df_scm10_only = df_merged_sms_scm10[df_merged_sms_scm10.get("PL DICH VU", "") == "SCM010"] if not df_merged_sms_scm10.empty else pd.DataFrame()
-    cif_scm10_set = set(df_scm10_only["ORGKEY"].astype(str).dropna()) if not df_scm10_only.empty and "ORGKEY" in df_scm10_only.columns else set()
-
-    merged["TK có đăng ký SMS"] = merged.get("TK_DUOC_UY_QUYEN", pd.Series(dtype=str)).astype(str).apply(lambda x: "X" if str(x) in tk_sms_set else "")
-    merged["CIF có đăng ký SCM010"] = merged.get("CIF_NGUOI_UY_QUYEN", pd.Series(dtype=str)).astype(str).apply(lambda x: "X" if str(x) in cif_scm10_set else "")
+    cif = merged["CIF_NGUOI_UY_QUYEN"]
+    merged["TK có đăng ký SMS"] = np.where(tk.isin(tk_sms_set), "X", "")
+    merged["CIF có đăng ký SCM010"] = np.where(cif.isin(cif_scm10_set), "X", "")
 
     # --- 5. 1 người nhận nhiều UQ (tiêu chí 3) ---
     df_tc3 = merged.copy()
     if "NGUOI_DUOC_UY_QUYEN" in df_tc3.columns and "NGUOI_UY_QUYEN" in df_tc3.columns:
-        grouped = df_tc3.groupby("NGUOI_DUOC_UY_QUYEN")["NGUOI_UY_QUYEN"].nunique().reset_index()
-        grouped = grouped[grouped["NGUOI_UY_QUYEN"] >= 2]
-        nguoi_nhan_nhieu_uq = set(grouped["NGUOI_DUOC_UY_QUYEN"].astype(str).dropna())
-        df_tc3["1 người nhận UQ của nhiều người"] = df_tc3["NGUOI_DUOC_UY_QUYEN"].astype(str).apply(lambda x: "X" if x in nguoi_nhan_nhieu_uq else "")
+        so_nguoi_uq = df_tc3.groupby("NGUOI_DUOC_UY_QUYEN")["NGUOI_UY_QUYEN"].transform("nunique")
+        df_tc3["1 người nhận UQ của nhiều người"] = np.where(so_nguoi_uq >= 2, "X", "")
     else:
         df_tc3["1 người nhận UQ của nhiều người"] = ""
 
@@ -401,45 +507,36 @@ def process_tieuchi_4_5(
     # =====================================================
     # 1) GHÉP + LỌC TIÊU CHÍ 4.2.a
     # =====================================================
-    frames = []
-    for f in files_42a_upload:
-        try:
-            frames.append(read_excel_file_bytesio(f))
-        except Exception:
-            if isinstance(f, tuple) and hasattr(f[1], "read"):
-                frames.append(read_excel_file_bytesio(f[1]))
-            else:
-                raise
-
-    if not frames:
-        return pd.DataFrame(), pd.DataFrame()
-
-    df_42a = pd.concat(frames, ignore_index=True)
-
-    if "BRCD" in df_42a.columns and chi_nhanh:
-        df_42a = df_42a[
-            df_42a["BRCD"].astype(str).str.upper().str.contains(chi_nhanh)
-        ]
-
     cols_42a = [
         "BRCD", "DEPTCD", "CUST_TYPE", "CUSTSEQ", "NMLOC", "BIRTH_DAY",
         "IDXACNO", "SCHM_NAME", "CCYCD", "CURBAL_VN",
         "OPNDT_FIRST", "OPNDT_EFFECT"
     ]
+
+    # Chỉ đọc các cột cần dùng và lọc chi nhánh ngay trên từng file trước khi ghép
+    def _loc_chi_nhanh(df):
+        if "BRCD" in df.columns and chi_nhanh:
+            # chi_nhanh là mã SOL (chuỗi cố định): so khớp chuỗi con, không qua regex engine
+            df = df[df["BRCD"].str.contains(chi_nhanh, case=False, regex=False, na=False)]
+        return df
+
+    frames = [_loc_chi_nhanh(df) for df in read_excel_files(files_42a_upload, usecols=cols_42a)]
+
+    if not frames:
+        return pd.DataFrame(), pd.DataFrame()
+
+    df_42a = concat_columns(frames, cols_42a)
     df_42a = ensure_columns(df_42a, cols_42a)[cols_42a]
 
     # Chỉ giữ KHCN
     df_42a = df_42a[
-        df_42a["CUST_TYPE"].astype(str).str.upper() == "KHCN"
+        df_42a["CUST_TYPE"].str.upper() == "KHCN"
     ]
 
     # Loại TK không hợp lệ
-    exclude_keywords = ["KY QUY", "GIAI NGAN", "CHI LUONG", "TKTT THE", "TRUNG GIAN"]
     df_42a = df_42a[
         ~df_42a["SCHM_NAME"]
-        .astype(str)
-        .str.upper()
-        .str.contains("|".join(exclude_keywords), na=False)
+        .str.contains(_EXCL_SCHM_PAT, na=False)
     ]
 
     # =====================================================
@@ -451,36 +548,21 @@ def process_tieuchi_4_5(
         ["MACIF", "STKKH", "CHARGELEVELCODE_CIF", "CHARGELEVELCODE_TK"]
     )
 
-    df_42a["CUSTSEQ"] = df_42a["CUSTSEQ"].astype(str)
-    df_42a["IDXACNO"] = df_42a["IDXACNO"].astype(str)
-    df_42b["MACIF"] = df_42b["MACIF"].astype(str)
-    df_42b["STKKH"] = df_42b["STKKH"].astype(str)
-
-    # Merge theo CIF
-    df_42a = df_42a.merge(
-        df_42b.drop_duplicates("MACIF")[["MACIF", "CHARGELEVELCODE_CIF"]],
-        left_on="CUSTSEQ",
-        right_on="MACIF",
-        how="left"
-    )
-    df_42a.rename(
-        columns={"CHARGELEVELCODE_CIF": "CHARGELEVELCODE_CUA_CIF"},
-        inplace=True
+    # Join theo CIF (bảng phải đã index theo khóa, mỗi khóa 1 dòng)
+    cif_level = (
+        df_42b.drop_duplicates("MACIF")
+        .set_index("MACIF")["CHARGELEVELCODE_CIF"]
+        .rename("CHARGELEVELCODE_CUA_CIF")
     )
-    df_42a.drop(columns="MACIF", inplace=True, errors="ignore")
+    df_42a = df_42a.join(cif_level, on="CUSTSEQ", validate="m:1")
 
-    # Merge theo TK
-    df_42a = df_42a.merge(
-        df_42b.drop_duplicates("STKKH")[["STKKH", "CHARGELEVELCODE_TK"]],
-        left_on="IDXACNO",
-        right_on="STKKH",
-        how="left"
+    # Join theo TK
+    tk_level = (
+        df_42b.drop_duplicates("STKKH")
+        .set_index("STKKH")["CHARGELEVELCODE_TK"]
+        .rename("CHARGELEVELCODE_CUA_TK")
     )
-    df_42a.rename(
-        columns={"CHARGELEVELCODE_TK": "CHARGELEVELCODE_CUA_TK"},
-        inplace=True
-    )
-    df_42a.drop(columns="STKKH", inplace=True, errors="ignore")
+    df_42a = df_42a.join(tk_level, on="IDXACNO", validate="m:1")
 
     df_42a["TK_GAN_CODE_UU_DAI_CBNV"] = np.where(
         df_42a["CHARGELEVELCODE_CUA_TK"] == "NVEIB", "X", ""
@@ -507,23 +589,15 @@ def process_tieuchi_4_5(
     df_42d = read_excel_file_bytesio(file_42d_upload)
     df_42d = ensure_columns(df_42d, ["CIF", "Ngày thôi việc"])
 
-    df_42a = df_42a.merge(
-        df_42d[["CIF", "Ngày thôi việc"]],
-        left_on="CUSTSEQ",
-        right_on="CIF",
-        how="left"
-    )
+    # join thẳng cột ngày (đã đổi tên) theo CIF, không tạo rồi drop cột CIF trung gian
+    ngay_nghi = df_42d.set_index("CIF")["Ngày thôi việc"].rename("NGAY_NGHI_VIEC")
+    df_42a = df_42a.join(ngay_nghi, on="CUSTSEQ").reset_index(drop=True)
 
-    df_42a["CBNV_NGHI_VIEC"] = np.where(df_42a["CIF"].notna(), "X", "")
-    df_42a.rename(
-        columns={"Ngày thôi việc": "NGAY_NGHI_VIEC"},
-        inplace=True
-    )
+    df_42a["CBNV_NGHI_VIEC"] = np.where(df_42a["CUSTSEQ"].isin(df_42d["CIF"].dropna()), "X", "")
     df_42a["NGAY_NGHI_VIEC"] = (
         safe_to_datetime(df_42a["NGAY_NGHI_VIEC"])
         .dt.strftime("%m/%d/%Y")
     )
-    df_42a.drop(columns="CIF", inplace=True, errors="ignore")
 
     # =====================================================
     # 5) TIÊU CHÍ 5 – MAPPING THẺ
@@ -538,27 +612,100 @@ def process_tieuchi_4_5(
     ]
     df_map = ensure_columns(df_map, need_cols)[need_cols]
 
-    df_map["uploaddt"] = safe_to_datetime(df_map["uploaddt"])
-    df_map["xpcodedt"] = safe_to_datetime(df_map["xpcodedt"])
+    # parse 1 lần ra Series datetime64 riêng; tính toán xong mới ghi lại dạng chuỗi
+    uploaddt = safe_to_datetime(df_map["uploaddt"])
+    xpcodedt = safe_to_datetime(df_map["xpcodedt"])
 
-    df_map["SO_NGAY_MO_THE"] = (
-        df_map["xpcodedt"] - df_map["uploaddt"]
-    ).dt.days
-
-    df_map["MO_DONG_TRONG_6_THANG"] = df_map.apply(
-        lambda r: "X"
-        if pd.notnull(r["SO_NGAY_MO_THE"])
-           and 0 <= r["SO_NGAY_MO_THE"] < 180
-           and r["uploaddt"] > pd.to_datetime("2025-06-30")
-        else "",
-        axis=1
+    days = (xpcodedt - uploaddt).dt.days
+    mask = (
+        days.notna()
+        & days.ge(0)
+        & days.lt(180)
+        & uploaddt.gt(pd.Timestamp("2025-06-30"))
     )
+    df_map["SO_NGAY_MO_THE"] = days
+    df_map["MO_DONG_TRONG_6_THANG"] = np.where(mask, "X", "")
 
-    df_map["xpcodedt"] = df_map["xpcodedt"].dt.strftime("%m/%d/%Y")
-    df_map["uploaddt"] = df_map["uploaddt"].dt.strftime("%m/%d/%Y")
+    df_map["xpcodedt"] = xpcodedt.dt.strftime("%m/%d/%Y")
+    df_map["uploaddt"] = uploaddt.dt.strftime("%m/%d/%Y")
 
     return df_42a, df_map
 
+# ---------------------------
+# Preview trên UI
+# ---------------------------
+PREVIEW_ROWS = 200
+# Tiêu chí 3: chỉ gửi các cột cần soát xuống trình duyệt (file Excel vẫn đủ cột)
+PREVIEW_COLS_TC3 = [
+    "PRIMARY_SOL_ID", "NGUOI_UY_QUYEN", "NGUOI_DUOC_UY_QUYEN", "TK_DUOC_UY_QUYEN",
+    "CIF_NGUOI_UY_QUYEN", "LOAI_TK", "KHONG_NHAP_TGIAN_UQ", "UQ_TREN_50_NAM",
+    "TK có đăng ký SMS", "CIF có đăng ký SCM010", "1 người nhận UQ của nhiều người",
+]
+
+
+def preview_frame(df: pd.DataFrame, cols: Optional[List[str]] = None) -> pd.DataFrame:
+    """PREVIEW_ROWS dòng đầu (không Styler), chỉ các cột trong cols nếu có"""
+    if cols is not None:
+        df = df[[c for c in cols if c in df.columns]]
+    return df.head(PREVIEW_ROWS)
+
+
+# ---------------------------
+# Cache kết quả theo file upload
+# ---------------------------
+def _upload_key(f):
+    """Khóa cache của file upload: (tên, kích thước, file_id) — không cần hash nội dung"""
+    return (getattr(f, "name", None), getattr(f, "size", None), getattr(f, "file_id", None))
+
+
+def excel_inputs(upload) -> List:
+    """ZIP -> list (name, handle) các Excel bên trong; 1 file Excel -> [upload]"""
+    if upload is None:
+        return []
+    name = upload.name.lower()
+    if name.endswith(".zip"):
+        return extract_excel_from_zip_bytes(upload)
+    if name.endswith((".xls", ".xlsx")):
+        return [upload]
+    return []
+
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={UploadedFile: _upload_key})
+def run_tieuchi_1_3_cached(ckh_upload, kkh_upload, muc30_upload, sms_zip_upload, scm10_upload):
+    """Chạy tiêu chí 1-3 và xuất Excel (+ Parquet); rerun cùng bộ file (vd bấm tải) dùng lại kết quả"""
+    sms_io, _ = extract_text_from_zip_bytes(sms_zip_upload)
+    merged, df_tc3 = process_uyquyen_sms_scm(
+        excel_inputs(ckh_upload),
+        excel_inputs(kkh_upload),
+        muc30_upload,
+        sms_io,
+        scm10_upload
+    )
+    sheets = {
+        "UyQuyen": merged,
+        "UyQuyen_TC3": df_tc3
+    }
+    return df_tc3, excel_bytes(sheets), to_parquet_zip_bytes(sheets)
+
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={UploadedFile: _upload_key})
+def run_tieuchi_4_5_cached(files_42a_upload, file_42b_upload, file_42c_upload, file_42d_upload, file_mapping_upload, chi_nhanh: str):
+    """Chạy tiêu chí 4-5 và xuất Excel (+ Parquet); đổi chi_nhanh chỉ chạy lại phần xử lý (file đã parse được cache)"""
+    df_42a_final, df_mapping_final = process_tieuchi_4_5(
+        files_42a_upload=excel_inputs(files_42a_upload),
+        file_42b_upload=file_42b_upload,
+        file_42c_upload=file_42c_upload,
+        file_42d_upload=file_42d_upload,
+        file_mapping_upload=file_mapping_upload,
+        chi_nhanh=chi_nhanh
+    )
+    sheets = {
+        "Tieu_chi_4": df_42a_final,
+        "Tieu_chi_5": df_mapping_final
+    }
+    return df_42a_final, df_mapping_final, excel_bytes(sheets), to_parquet_zip_bytes(sheets)
+
+
 # ---------------------------
 # STREAMLIT UI PUBLIC FUNCTION
 # ---------------------------
@@ -590,25 +737,9 @@ def _run_dvkh_5_tieuchi():
         uploaded_ckh_zip = st.file_uploader("HDV_CHITIET_CKH.zip (nhiều file Excel bên trong) - (hoặc upload list Excel)", type=["zip","xls","xlsx"], accept_multiple_files=False, key="dvkh_ckh_zip")
         uploaded_kkh_zip = st.file_uploader("HDV_CHITIET_KKH.zip (nhiều file Excel bên trong) - (hoặc upload list Excel)", type=["zip","xls","xlsx"], accept_multiple_files=False, key="dvkh_kkh_zip")
 
-        # Hỗ trợ both: nếu user upload zip thì extract; nếu upload multiple excel (older UI) thì có thể thay đổi
-        uploaded_ckh_files = []
-        uploaded_kkh_files = []
-
-        # nếu upload zip cho CKH
-        if uploaded_ckh_zip and uploaded_ckh_zip.type == "application/x-zip-compressed" or (uploaded_ckh_zip and uploaded_ckh_zip.name.lower().endswith(".zip")):
-            ckh_list = extract_excel_from_zip_bytes(uploaded_ckh_zip)
-            uploaded_ckh_files = [ (name, buf) for name, buf in ckh_list ]
-        else:
-            # nếu user chọn một excel file (không zip), hỗ trợ upload nhiều bằng interface khác -> try to use as single Excel
-            if uploaded_ckh_zip and uploaded_ckh_zip.name.lower().endswith((".xls", ".xlsx")):
-                uploaded_ckh_files = [uploaded_ckh_zip]
-
-        if uploaded_kkh_zip and uploaded_kkh_zip.type == "application/x-zip-compressed" or (uploaded_kkh_zip and uploaded_kkh_zip.name.lower().endswith(".zip")):
-            kkh_list = extract_excel_from_zip_bytes(uploaded_kkh_zip)
-            uploaded_kkh_files = [ (name, buf) for name, buf in kkh_list ]
-        else:
-            if uploaded_kkh_zip and uploaded_kkh_zip.name.lower().endswith((".xls", ".xlsx")):
-                uploaded_kkh_files = [uploaded_kkh_zip]
+        # Hỗ trợ both: upload zip (nhiều Excel bên trong) hoặc 1 file Excel
+        uploaded_ckh_files = excel_inputs(uploaded_ckh_zip)
+        uploaded_kkh_files = excel_inputs(uploaded_kkh_zip)
 
         uploaded_muc30_file = st.file_uploader("MUC 30 (Muc30) - single", type=["xls","xlsx"], key="dvkh_muc30")
         uploaded_sms_zip = st.file_uploader("Muc14_DKSMS.zip (bên trong chứa 1 file .txt)", type=["zip"], key="dvkh_sms_zip")
@@ -620,7 +751,7 @@ def _run_dvkh_5_tieuchi():
                 st.error("Vui lòng upload đủ: CKH (zip hoặc excel), KKH (zip hoặc excel), MUC30, ZIP chứa Muc14_DKSMS.txt, Muc14_SCM010.xlsx")
                 audit_log("run_tieuchi_1_3_failed", "missing files", user)
             else:
-                # giải nén SMS txt
+                # kiểm tra ZIP SMS có file .txt
                 sms_io, sms_name = extract_text_from_zip_bytes(uploaded_sms_zip)
                 if sms_io is None:
                     st.error("Không tìm thấy file .txt trong ZIP SMS. Vui lòng kiểm tra ZIP.")
@@ -628,22 +759,20 @@ def _run_dvkh_5_tieuchi():
                 else:
                     try:
                         audit_log("run_tieuchi_1_3_start", f"CKH_files:{len(uploaded_ckh_files)} KKH_files:{len(uploaded_kkh_files)}", user)
-                        merged, df_tc3 = process_uyquyen_sms_scm(
-                            uploaded_ckh_files,
-                            uploaded_kkh_files,
+                        df_tc3, out_bytes, pq_bytes = run_tieuchi_1_3_cached(
+                            uploaded_ckh_zip,
+                            uploaded_kkh_zip,
                             uploaded_muc30_file,
-                            sms_io,
+                            uploaded_sms_zip,
                             uploaded_scm10_xlsx_file
                         )
                         st.success("Xử lý xong Tiêu chí 1-3")
                         st.subheader("Preview Tiêu chí 3")
-                        st.dataframe(df_tc3.head(200), use_container_width=True)
+                        st.dataframe(preview_frame(df_tc3, PREVIEW_COLS_TC3), use_container_width=True)
 
-                        out_bytes = to_excel_bytes({
-                            "UyQuyen": merged,
-                            "UyQuyen_TC3": df_tc3
-                        })
                         st.download_button("📥 Tải Excel Tiêu chí 1-3", data=out_bytes, file_name="DVKH_TC1_3.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                        if pq_bytes is not None:
+                            st.download_button("📦 Tải Parquet Tiêu chí 1-3 (ZIP)", data=pq_bytes, file_name="DVKH_TC1_3_parquet.zip", mime="application/zip")
                         audit_log("run_tieuchi_1_3_success", f"rows:{len(df_tc3)}", user)
                     except Exception as e:
                         st.error("Đã xảy ra lỗi trong quá trình xử lý Tiêu chí 1-3.")
@@ -667,36 +796,28 @@ def _run_dvkh_5_tieuchi():
                 audit_log("run_tieuchi_4_5_failed", "missing inputs", user)
             else:
                 try:
-                    # Nếu files_42a_upload là zip -> extract
-                    files_42a_list = []
-                    if files_42a_upload.name.lower().endswith(".zip"):
-                        ex = extract_excel_from_zip_bytes(files_42a_upload)
-                        files_42a_list = [(name, buf) for name, buf in ex]
-                    else:
-                        # nếu là 1 excel: dùng trực tiếp
-                        files_42a_list = [files_42a_upload]
+                    # zip -> các Excel bên trong; 1 excel -> dùng trực tiếp
+                    files_42a_list = excel_inputs(files_42a_upload)
 
                     audit_log("run_tieuchi_4_5_start", f"chi_nhanh={chi_nhanh} files_42a={len(files_42a_list)}", user)
-                    df_42a_final, df_mapping_final = process_tieuchi_4_5(
-                        files_42a_upload=files_42a_list,
-                        file_42b_upload=file_42b_upload,
-                        file_42c_upload=file_42c_upload,
-                        file_42d_upload=file_42d_upload,
-                        file_mapping_upload=file_mapping_upload,
-                        chi_nhanh=chi_nhanh
+                    df_42a_final, df_mapping_final, out_bytes, pq_bytes = run_tieuchi_4_5_cached(
+                        files_42a_upload,
+                        file_42b_upload,
+                        file_42c_upload,
+                        file_42d_upload,
+                        file_mapping_upload,
+                        chi_nhanh
                     )
 
                     st.success("Xử lý xong Tiêu chí 4-5")
                     st.subheader("Preview Tiêu chí 4 (42a)")
-                    st.dataframe(df_42a_final.head(200), use_container_width=True)
+                    st.dataframe(preview_frame(df_42a_final), use_container_width=True)
                     st.subheader("Preview Tiêu chí 5 (Mapping)")
-                    st.dataframe(df_mapping_final.head(200), use_container_width=True)
+                    st.dataframe(preview_frame(df_mapping_final), use_container_width=True)
 
-                    out_bytes = to_excel_bytes({
-                        "Tieu_chi_4": df_42a_final,
-                        "Tieu_chi_5": df_mapping_final
-                    })
                     st.download_button("📥 Tải Excel Tiêu chí 4-5", data=out_bytes, file_name="DVKH_TC4_5.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                    if pq_bytes is not None:
+                        st.download_button("📦 Tải Parquet Tiêu chí 4-5 (ZIP)", data=pq_bytes, file_name="DVKH_TC4_5_parquet.zip", mime="application/zip")
                     audit_log("run_tieuchi_4_5_success", f"rows4:{len(df_42a_final)} rows5:{len(df_mapping_final)}", user)
                 except Exception as e:
                     st.error("Đã xảy ra lỗi trong quá trình xử lý Tiêu chí 4-5.")
@@ -729,30 +850,36 @@ def _run_dvkh_5_tieuchi():
     if st.session_state.get("role") == "admin":
     
         st.markdown("---")
-        st.header("🔐 Audit & Logs (Admin)")
-    
-        st.write("Nhật ký hoạt động DVKH (local file):")
-    
-        if os.path.exists(AUDIT_FILE):
-            try:
-                df_audit = pd.read_csv(AUDIT_FILE)
-                st.dataframe(
-                    df_audit.sort_values("timestamp", ascending=False).head(200),
-                    use_container_width=True,
-                )
+        # expander vẫn chạy code bên trong mỗi lần rerun -> chỉ đọc / render log sau khi admin bấm mở
+        with st.expander("🔐 Audit & Logs (Admin)", expanded=False):
+            st.write("Nhật ký hoạt động DVKH (local file):")
+            if not st.session_state.get("_show_audit"):
+                if st.button("Mở nhật ký audit", key="_show_audit_btn"):
+                    st.session_state["_show_audit"] = True
+                    st.rerun()
+            elif os.path.exists(AUDIT_FILE) or os.path.exists(LEGACY_AUDIT_FILE):
+                try:
+                    # chỉ đọc phần cuối file (200 dòng mới nhất), cache theo mtime
+                    df_audit = read_audit_tail(PREVIEW_ROWS, _mtime(AUDIT_FILE), _mtime(LEGACY_AUDIT_FILE))
+                    # ghi chú (vd traceback) có thể rất dài: chỉ hiển thị 200 ký tự đầu, file tải về vẫn đủ
+                    note = df_audit["note"].astype("string").str.slice(0, 200)
+                    st.dataframe(df_audit.assign(note=note), use_container_width=True)
     
-                csv_bytes = df_audit.to_csv(index=False).encode("utf-8-sig")
-                st.download_button(
-                    "📥 Tải Log Audit (CSV)",
-                    data=csv_bytes,
-                    file_name="dvkh_audit.csv",
-                    mime="text/csv",
-                )
-            except Exception as e:
-                st.error("❌ Không thể đọc file audit.")
-                st.exception(e)
-        else:
-            st.info("ℹ️ Chưa có log hoạt động (file dvkh_audit.csv chưa tồn tại).")
+                    # file CSV đầy đủ chỉ được tạo khi bấm tải
+                    st.download_button(
+                        "📥 Tải Log Audit (CSV)",
+                        data=lambda: read_audit_log().to_csv(index=False).encode("utf-8-sig"),
+                        file_name="dvkh_audit.csv",
+                        mime="text/csv",
+                    )
+                except Exception as e:
+                    st.error("❌ Không thể đọc file audit.")
+                    st.exception(e)
+            else:
+                st.info("ℹ️ Chưa có log hoạt động (file dvkh_audit.jsonl chưa tồn tại).")
+            if st.session_state.get("_show_audit") and st.button("Ẩn nhật ký audit", key="_hide_audit_btn"):
+                st.session_state["_show_audit"] = False
+                st.rerun()
     
     else:
         # Ẩn hoàn toàn, hoặc chỉ hiển thị thông báo nhẹ
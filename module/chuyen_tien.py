@@ -1,19 +1,79 @@
 import streamlit as st
 import pandas as pd
-from io import BytesIO
 import re
 
+from module.excel_utils import excel_bytes, read_excel_calamine
+
+_WS_RE = re.compile(r"\s+")
+_BAD_CHAR_RE = re.compile(r"[^\w\s\-\.]")
+
 
 def _safe_colname(s: str) -> str:
     """Làm sạch tên cột để an toàn khi ghép header."""
     s = "" if s is None else str(s)
     s = s.strip()
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"[^\w\s\-\.]", "_", s)  # thay ký tự lạ bằng _
+    s = _WS_RE.sub(" ", s)
+    s = _BAD_CHAR_RE.sub("_", s)  # thay ký tự lạ bằng _
     s = s.replace(" ", "_")
     return s[:120]  # tránh header quá dài
 
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def _read_muc09(raw: bytes, cols: tuple) -> pd.DataFrame:
+    """
+    Đọc file Mục 09 từ bytes, chỉ giữ các cột cần dùng (cột thiếu không gây lỗi, kiểm tra sau).
+    Cache theo nội dung file: bấm chạy lại không parse lại Excel.
+    """
+    return read_excel_calamine(raw, usecols=lambda c: c in cols)
+
+
+def tong_hop_chuyen_tien(df: pd.DataFrame, cac_nam: list) -> pd.DataFrame:
+    """
+    Tổng hợp số lần nhận / tổng tiền USD theo PART_NAME x PURPOSE_OF_REMITTANCE x năm.
+    1 lần groupby + unstack thay cho lọc/merge từng mục đích x năm.
+    Cột: {muc_dich}_LAN_{nam}, {muc_dich}_TIEN_{nam} (mục đích theo thứ tự xuất hiện, năm tăng dần).
+    """
+    ds_muc_dich = df["PURPOSE_OF_REMITTANCE"].dropna().unique()
+    df = df[df["YEAR"].isin(cac_nam) & df["PURPOSE_OF_REMITTANCE"].notna()]
+    if df.empty:
+        return pd.DataFrame()
+    # khóa nhóm dạng category: groupby trên mã số nguyên thay vì hash chuỗi
+    df = df.assign(
+        YEAR=df["YEAR"].astype(int),
+        PART_NAME=df["PART_NAME"].astype("category"),
+        PURPOSE_OF_REMITTANCE=df["PURPOSE_OF_REMITTANCE"].astype("category"),
+    )
+
+    agg = df.groupby(["PART_NAME", "PURPOSE_OF_REMITTANCE", "YEAR"], observed=True).agg(
+        lan=("TRAN_ID", "count"),
+        tien=("QUY_DOI_USD", "sum")
+    )
+    if agg.empty:
+        return pd.DataFrame()
+    wide = agg.unstack(["PURPOSE_OF_REMITTANCE", "YEAR"])
+
+    # chỉ các cặp (mục đích, năm) có dữ liệu, giữ thứ tự cột như bản tổng hợp cũ
+    co_du_lieu = set(zip(
+        agg.index.get_level_values("PURPOSE_OF_REMITTANCE"),
+        agg.index.get_level_values("YEAR")
+    ))
+    cols, names = [], []
+    for muc_dich in ds_muc_dich:
+        muc_dich_safe = _safe_colname(muc_dich)
+        for nam in cac_nam:
+            if (muc_dich, nam) in co_du_lieu:
+                cols += [("lan", muc_dich, nam), ("tien", muc_dich, nam)]
+                names += [f"{muc_dich_safe}_LAN_{nam}", f"{muc_dich_safe}_TIEN_{nam}"]
+
+    # FILL NA + ÉP KIỂU: 1 lần cho cả bảng; số lần dùng int32 (đủ cho đếm giao dịch),
+    # số tiền giữ float64 để không mất chính xác
+    wide = wide[cols].fillna(0).astype({c: ("int32" if c[0] == "lan" else "float64") for c in cols})
+    wide.columns = names
+    # trả PART_NAME về kiểu gốc (không để category lọt ra bảng kết quả)
+    wide.index = wide.index.astype(wide.index.categories.dtype)
+    return wide.reset_index()
+
+
 def run_chuyen_tien():
     uploaded = st.file_uploader(
         "📁 Upload file Mục 09 (Chuyển tiền)",
@@ -26,11 +86,13 @@ def run_chuyen_tien():
 
     if st.button("▶️ Chạy Mục 09"):
 
+        required_cols = ["TRAN_DATE", "PART_NAME", "PURPOSE_OF_REMITTANCE", "TRAN_ID", "QUY_DOI_USD"]
+
         # ================================
         # ĐỌC FILE – BẮT LỖI
         # ================================
         try:
-            df = pd.read_excel(uploaded)
+            df = _read_muc09(uploaded.getvalue(), tuple(required_cols))
         except Exception as e:
             st.error("❌ Không đọc được file Excel.")
             st.exception(e)
@@ -43,7 +105,6 @@ def run_chuyen_tien():
         # ================================
         # KIỂM TRA CỘT BẮT BUỘC
         # ================================
-        required_cols = ["TRAN_DATE", "PART_NAME", "PURPOSE_OF_REMITTANCE", "TRAN_ID", "QUY_DOI_USD"]
         missing_cols = [c for c in required_cols if c not in df.columns]
         if missing_cols:
             st.error("❌ File thiếu cột bắt buộc:")
@@ -87,7 +148,6 @@ def run_chuyen_tien():
         # ================================
         # TỔNG HỢP
         # ================================
-        ket_qua = pd.DataFrame()
         ds_muc_dich = df["PURPOSE_OF_REMITTANCE"].dropna().unique()
 
         if len(ds_muc_dich) == 0:
@@ -95,31 +155,7 @@ def run_chuyen_tien():
             return
 
         try:
-            for muc_dich in ds_muc_dich:
-                df_muc_dich = df[df["PURPOSE_OF_REMITTANCE"] == muc_dich]
-                muc_dich_safe = _safe_colname(muc_dich)
-
-                for nam in cac_nam:
-                    df_nam = df_muc_dich[df_muc_dich["YEAR"] == nam]
-                    if df_nam.empty:
-                        continue
-
-                    pivot = df_nam.groupby("PART_NAME").agg(
-                        tong_lan_nhan=("TRAN_ID", "count"),
-                        tong_tien_usd=("QUY_DOI_USD", "sum")
-                    ).reset_index()
-
-                    col_lan = f"{muc_dich_safe}_LAN_{nam}"
-                    col_tien = f"{muc_dich_safe}_TIEN_{nam}"
-
-                    pivot.rename(columns={
-                        "tong_lan_nhan": col_lan,
-                        "tong_tien_usd": col_tien
-                    }, inplace=True)
-
-                    ket_qua = pivot if ket_qua.empty else pd.merge(
-                        ket_qua, pivot, on="PART_NAME", how="outer"
-                    )
+            ket_qua = tong_hop_chuyen_tien(df, cac_nam)
         except Exception as e:
             st.error("❌ Lỗi khi tổng hợp/pivot dữ liệu.")
             st.exception(e)
@@ -129,15 +165,6 @@ def run_chuyen_tien():
             st.warning("⚠️ Không có dữ liệu sau khi tổng hợp (có thể 3 năm gần nhất không có giao dịch).")
             return
 
-        # ================================
-        # FILL NA + ÉP KIỂU
-        # ================================
-        for col in ket_qua.columns:
-            if "_LAN_" in col:
-                ket_qua[col] = ket_qua[col].fillna(0).astype(int)
-            elif "_TIEN_" in col:
-                ket_qua[col] = ket_qua[col].fillna(0).astype(float)
-
         # ================================
         # THÔNG BÁO
         # ================================
@@ -157,23 +184,18 @@ def run_chuyen_tien():
         # XUẤT FILE
         # ================================
         try:
-            buffer = BytesIO()
-            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-                ket_qua.to_excel(writer, sheet_name="tong_hop", index=False)
-
-                # Sheet meta (tuỳ chọn)
-                meta = pd.DataFrame([{
-                    "nam_T2": nam_T2, "nam_T1": nam_T1, "nam_T": nam_T,
-                    "invalid_dates": invalid_dates,
-                    "removed_duplicates": removed_dup,
-                    "so_muc_dich": len(ds_muc_dich),
-                    "rows_after_dedup": len(df)
-                }])
-                meta.to_excel(writer, sheet_name="meta", index=False)
+            # Sheet meta (tuỳ chọn)
+            meta = pd.DataFrame([{
+                "nam_T2": nam_T2, "nam_T1": nam_T1, "nam_T": nam_T,
+                "invalid_dates": invalid_dates,
+                "removed_duplicates": removed_dup,
+                "so_muc_dich": len(ds_muc_dich),
+                "rows_after_dedup": len(df)
+            }])
 
             st.download_button(
                 "⬇️ Tải file tong_hop_chuyen_tien.xlsx",
-                data=buffer.getvalue(),
+                data=excel_bytes({"tong_hop": ket_qua, "meta": meta}),
                 file_name=f"tong_hop_chuyen_tien_{nam_T2}_{nam_T}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
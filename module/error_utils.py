@@ -107,11 +107,13 @@ def validate_branch_has_data(df, col: str, sol_4: str, src_name: str) -> None:
     sol = validate_sol_only(sol_4)
 
     # Chuẩn hoá dữ liệu SOL trong df: về string và zfill(4)
+    # (vector hoá: zfill trên cả cột, chỉ giữ kết quả ở các ô toàn chữ số; ô rỗng/NaN giữ nguyên)
     series = df[col].astype(str).str.strip()
-    series = series.apply(lambda x: x.zfill(4) if x.isdigit() else x)
+    la_so = series.str.isdigit().fillna(False).astype(bool)
+    series = series.where(~la_so, series.str.zfill(4))
 
-    n = (series == sol).sum()
-    if n == 0:
+    # chỉ cần biết có hay không: so sánh trên cột chuỗi (Arrow) rồi any(), không đếm
+    if not series.eq(sol).any():
         raise UserFacingError(
             f"Không tìm thấy dữ liệu {src_name} theo mã SOL '{sol}'. "
             "Vui lòng kiểm tra lại mã SOL."
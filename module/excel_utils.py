@@ -0,0 +1,39 @@
+# ==========================================================
+# module/excel_utils.py
+# TIỆN ÍCH ĐỌC / GHI EXCEL DÙNG CHUNG
+# ==========================================================
+
+from importlib.util import find_spec
+from io import BytesIO
+
+import pandas as pd
+
+# calamine (Rust, đọc được cả xls/xlsx) nếu đã cài python-calamine; không thì để pandas chọn engine mặc định
+_READ_ENGINE = "calamine" if find_spec("python_calamine") is not None else None
+
+
+def read_excel_calamine(raw: bytes, **kw) -> pd.DataFrame:
+    """
+    Đọc Excel từ bytes bằng engine chọn sẵn lúc import (calamine nếu có).
+    Chỉ parse 1 lần: lỗi file hỏng / usecols sai được ném ra ngay.
+    """
+    return pd.read_excel(BytesIO(raw), engine=_READ_ENGINE, **kw)
+
+
+def excel_bytes(dfs: dict, **writer_kw) -> bytes:
+    """
+    Ghi {tên sheet: DataFrame} ra xlsx (tên sheet cắt còn 31 ký tự); writer_kw truyền
+    thêm cho pd.ExcelWriter (ví dụ date_format).
+    Dùng xlsxwriter: ghi nhanh và ít bộ nhớ hơn openpyxl. Không bật constant_memory:
+    pandas ghi theo từng cột nên chế độ đó làm mất dữ liệu.
+    """
+    output = BytesIO()
+    with pd.ExcelWriter(
+        output,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"strings_to_urls": False}},
+        **writer_kw,
+    ) as writer:
+        for name, df in dfs.items():
+            df.to_excel(writer, sheet_name=name[:31], index=False)
+    return output.getvalue()
@@ -3,31 +3,110 @@
 # HDV – 3 TIÊU CHÍ (TC1–TC3) + VALIDATE SOL/CHI NHÁNH
 # ==========================================================
 
+import os
 import re
 import streamlit as st
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from typing import List, Optional, Tuple
 
 from module.error_utils import ensure_required_columns, render_error, UserFacingError,validate_sol_only
+from module.excel_utils import excel_bytes, read_excel_calamine
+
+try:  # pyarrow: ghi CSV đa luồng cho kết quả lớn
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
+
+# kết quả trên ngưỡng này: file xlsx chỉ tạo khi bấm tải, CSV ghi bằng pyarrow
+LARGE_RESULT_ROWS = 100_000
+# giới hạn dòng của 1 sheet Excel (trừ dòng tiêu đề)
+EXCEL_MAX_ROWS = 1_048_575
 
 
 # ==========================================================
 # UTILITIES
 # ==========================================================
 
-def download_excel(df: pd.DataFrame, filename: str):
-    buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="data")
-    buffer.seek(0)
+@st.cache_data(show_spinner=False, max_entries=16)
+def _read_excel_bytes(name: str, raw: bytes, usecols: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+    """Parse Excel (dtype=str) từ bytes; cache theo (tên file, nội dung, cột cần đọc) để rerun không parse lại"""
+    # usecols: chỉ giữ các cột có tên trong danh sách; cột thiếu không gây lỗi parse
+    # (ensure_required_columns báo thiếu cột bằng thông điệp thân thiện)
+    cols = None if usecols is None else (lambda c: c in usecols)
+    return read_excel_calamine(raw, dtype=str, usecols=cols)
+
+
+def read_excel_upload(uploaded_file, usecols=None) -> pd.DataFrame:
+    """Đọc 1 file upload qua cache parse; usecols: chỉ đọc các cột cần dùng"""
+    return _read_excel_bytes(
+        getattr(uploaded_file, "name", ""),
+        uploaded_file.getvalue(),
+        tuple(usecols) if usecols is not None else None,
+    )
+
+
+def read_excel_uploads(files, usecols=None) -> List[pd.DataFrame]:
+    """Đọc nhiều file upload song song bằng thread pool; giữ nguyên thứ tự file"""
+    files = list(files or [])
+    if len(files) <= 1:
+        return [read_excel_upload(f, usecols) for f in files]
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1, 8)) as ex:
+        return list(ex.map(lambda f: read_excel_upload(f, usecols), files))
+
+
+def _df_key(df: pd.DataFrame):
+    """Khóa cache của DataFrame: shape + tên cột + hash toàn bộ giá trị"""
+    return (df.shape, tuple(map(str, df.columns)), int(pd.util.hash_pandas_object(df, index=True).sum()))
 
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={pd.DataFrame: _df_key})
+def _excel_bytes(df: pd.DataFrame) -> bytes:
+    """Ghi df ra xlsx (1 sheet "data"); cùng dữ liệu thì dùng lại bytes đã ghi"""
+    return excel_bytes({"data": df})
+
+
+def _csv_bytes(df: pd.DataFrame) -> bytes:
+    """CSV utf-8-sig (Excel mở đúng tiếng Việt); ghi nhanh hơn xlsx nhiều lần"""
+    if pa_csv is not None and len(df) > LARGE_RESULT_ROWS:
+        # bảng lớn: writer C++ đa luồng của pyarrow; cột kiểu hỗn hợp không chuyển được thì dùng pandas
+        try:
+            buffer = BytesIO()
+            buffer.write(b"\xef\xbb\xbf")
+            pa_csv.write_csv(
+                pa.Table.from_pandas(df, preserve_index=False),
+                buffer,
+                pa_csv.WriteOptions(quoting_style="needed"),
+            )
+            return buffer.getvalue()
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+    return df.to_csv(index=False).encode("utf-8-sig")
+
+
+def download_excel(df: pd.DataFrame, filename: str):
+    if len(df) > EXCEL_MAX_ROWS:
+        st.warning(f"Kết quả có {len(df):,} dòng, vượt giới hạn 1 sheet Excel – chỉ tải được bản CSV.")
+    else:
+        st.download_button(
+            label="📥 Tải xuống " + filename,
+            # bảng lớn: chỉ ghi xlsx khi người dùng bấm tải
+            data=(lambda: _excel_bytes(df)) if len(df) > LARGE_RESULT_ROWS else _excel_bytes(df),
+            file_name=filename,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key=f"download_{filename}",
+        )
+    # bản CSV chỉ được tạo khi bấm tải
+    csv_name = filename.rsplit(".", 1)[0] + ".csv"
     st.download_button(
-        label="📥 Tải xuống " + filename,
-        data=buffer.getvalue(),
-        file_name=filename,
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key=f"download_{filename}",
+        label="📄 Tải CSV " + csv_name,
+        data=lambda: _csv_bytes(df),
+        file_name=csv_name,
+        mime="text/csv",
+        key=f"download_csv_{filename}",
     )
 
 
@@ -63,13 +142,33 @@ def download_excel(df: pd.DataFrame, filename: str):
 #     return s.upper()
 
 
+def left_lookup(df: pd.DataFrame, lookup: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    Gắn các cột của lookup vào df theo key (tương đương merge how="left").
+    Key của lookup không trùng -> tra bằng map, không dựng lại cả khung;
+    có trùng -> dùng merge để giữ nguyên kết quả (nhân dòng) như trước.
+    """
+    if not lookup[key].is_unique:
+        return df.merge(lookup, on=key, how="left")
+    bang = lookup.set_index(key)
+    out = df.copy()
+    for c in bang.columns:
+        out[c] = df[key].map(bang[c])
+    return out.reset_index(drop=True)
+
+
 def filter_by_sol_contains(df: pd.DataFrame, col: str, pattern: str) -> pd.DataFrame:
     """
     Lọc contains (case-insensitive). pattern đã được validate trước.
     """
     if pattern is None or str(pattern).strip() == "":
         return df
-    return df[df[col].astype(str).str.upper().str.contains(str(pattern).upper(), na=False)]
+    # mã chi nhánh lặp lại rất nhiều: so khớp (chuỗi con cố định, không regex) trên các giá trị
+    # khác nhau rồi tra ngược theo mã factorize; ô trống (mã -1) lấy phần tử False cuối mảng
+    codes, uniques = pd.factorize(df[col].astype(str))
+    hit = pd.Index(uniques).str.contains(str(pattern), case=False, regex=False)
+    hit = np.append(np.asarray(hit, dtype=bool), False)
+    return df[hit[codes]]
 
 
 # ==========================================================
@@ -154,10 +253,7 @@ Các file uplod gồm:
                     # READ CKH (KHÓA CỘT)
                     # =========================
                     df_ckh = pd.concat(
-                        [
-                            pd.read_excel(f, dtype=str, usecols=cols_ckh)
-                            for f in hdv_files
-                        ],
+                        read_excel_uploads(hdv_files, usecols=cols_ckh),
                         ignore_index=True
                     )
                     ensure_required_columns(df_ckh, cols_ckh)
@@ -167,10 +263,7 @@ Các file uplod gồm:
                     # READ FTP (KHÓA CỘT NGAY TỪ ĐẦU)
                     # =========================
                     df_ftp = pd.concat(
-                        [
-                            pd.read_excel(f, dtype=str, usecols=cols_ftp_use)
-                            for f in ftp_files
-                        ],
+                        read_excel_uploads(ftp_files, usecols=cols_ftp_use),
                         ignore_index=True
                     )
                     ensure_required_columns(df_ftp, cols_ftp_use)
@@ -184,7 +277,7 @@ Các file uplod gồm:
                     # =========================
                     # READ LS THỰC TRẢ (CHỈ LẤY 2 CỘT)
                     # =========================
-                    df_tt_raw = pd.read_excel(tt_file, dtype=str)
+                    df_tt_raw = read_excel_upload(tt_file)
                     ensure_required_columns(df_tt_raw, ["Số tài khoản", "Lãi suất thực trả"])
     
                     df_tt = (
@@ -201,38 +294,32 @@ Các file uplod gồm:
                     # =========================
                     # MERGE (KHÔNG BAO GIỜ DƯ CỘT)
                     # =========================
-                    df_merge = df_filtered.merge(
-                        df_ftp,
-                        on="IDXACNO",
-                        how="left"
-                    )
-    
-                    df_merge = df_merge.merge(
-                        df_tt,
-                        on="IDXACNO",
-                        how="left"
-                    )
+                    df_merge = left_lookup(df_filtered, df_ftp, "IDXACNO")
+                    df_merge = left_lookup(df_merge, df_tt, "IDXACNO")
     
                     # =========================
                     # CONVERT TO NUMERIC
                     # =========================
-                    for c in ["LS_GHISO", "LS_CONG_BO", "LS_FTP", "LS_THUC_TRA"]:
-                        df_merge[c] = pd.to_numeric(df_merge[c], errors="coerce")
+                    # đổi cả 4 cột lãi suất trong 1 lần gán; giữ float64 (float32 hiển thị 4.7 thành 4.699999...)
+                    ls_cols = ["LS_GHISO", "LS_CONG_BO", "LS_FTP", "LS_THUC_TRA"]
+                    df_merge[ls_cols] = df_merge[ls_cols].apply(pd.to_numeric, errors="coerce")
     
                     # =========================
                     # BUSINESS RULES
                     # =========================
-                    df_merge["LSGS ≠ LSCB"] = (
-                        df_merge["LS_GHISO"] != df_merge["LS_CONG_BO"]
-                    ).map({True: "X", False: ""})
+                    # so sánh trên mảng float (NaN != x là True, NaN > x là False như trước)
+                    ls_ghiso = df_merge["LS_GHISO"].to_numpy(dtype=float)
+                    df_merge["LSGS ≠ LSCB"] = np.where(
+                        ls_ghiso != df_merge["LS_CONG_BO"].to_numpy(dtype=float), "X", ""
+                    )
     
-                    df_merge["Không có LS trình duyệt"] = (
-                        df_merge["LS_THUC_TRA"].isna()
-                    ).map({True: "X", False: ""})
+                    df_merge["Không có LS trình duyệt"] = np.where(
+                        df_merge["LS_THUC_TRA"].isna().to_numpy(), "X", ""
+                    )
     
-                    df_merge["LSGS > FTP"] = (
-                        df_merge["LS_GHISO"] > df_merge["LS_FTP"]
-                    ).map({True: "X", False: ""})
+                    df_merge["LSGS > FTP"] = np.where(
+                        ls_ghiso > df_merge["LS_FTP"].to_numpy(dtype=float), "X", ""
+                    )
     
                     # =========================
                     # FINAL COLUMN LOCK (CHỐNG DƯ CỘT TUYỆT ĐỐI)
@@ -394,8 +481,8 @@ Các file uplod gồm:
                         "KH_VIP", "CIF_OPNDT"
                     ]
 
-                    df_ckh2 = pd.concat([pd.read_excel(f, dtype=str) for f in ckh_tc2], ignore_index=True)
-                    df_kkh2 = pd.concat([pd.read_excel(f, dtype=str) for f in kkh_tc2], ignore_index=True)
+                    df_ckh2 = pd.concat(read_excel_uploads(ckh_tc2, usecols=cols), ignore_index=True)
+                    df_kkh2 = pd.concat(read_excel_uploads(kkh_tc2, usecols=cols), ignore_index=True)
 
                     ensure_required_columns(df_ckh2, cols)
                     ensure_required_columns(df_kkh2, cols)
@@ -405,31 +492,37 @@ Các file uplod gồm:
 
                     df_filtered["CURBAL_VN"] = pd.to_numeric(df_filtered["CURBAL_VN"], errors="coerce")
 
-                    df_sum = (
-                        df_filtered.groupby("CUSTSEQ", as_index=False)["CURBAL_VN"]
-                        .sum()
-                        .rename(columns={"CURBAL_VN": "SỐ DƯ"})
-                    )
-                    df_tonghop = df_filtered.drop_duplicates("CUSTSEQ").merge(df_sum, on="CUSTSEQ", how="left")
+                    # tổng số dư theo KH, gắn vào dòng đầu của mỗi KH bằng map (không merge)
+                    sums = df_filtered.groupby("CUSTSEQ")["CURBAL_VN"].sum()
+                    df_tonghop = df_filtered.drop_duplicates("CUSTSEQ").reset_index(drop=True)
+                    df_tonghop["SỐ DƯ"] = df_tonghop["CUSTSEQ"].map(sums)
 
                     today = pd.Timestamp.today().normalize()
                     df_tonghop["BIRTH_DAY"] = pd.to_datetime(df_tonghop["BIRTH_DAY"], errors="coerce")
 
+                    # tuổi tròn: năm nay - năm sinh, trừ 1 nếu chưa tới sinh nhật (so tháng*100 + ngày)
+                    bd = df_tonghop["BIRTH_DAY"]
+                    chua_sinh_nhat = (bd.dt.month * 100 + bd.dt.day) > (today.month * 100 + today.day)
+                    tuoi = today.year - bd.dt.year - chua_sinh_nhat.astype(int)
+
                     mask = df_tonghop["CUST_TYPE"] == "KHCN"
-                    df_tonghop.loc[mask, "ĐỘ TUỔI"] = df_tonghop.loc[mask, "BIRTH_DAY"].apply(
-                        lambda x: today.year - x.year - ((today.month, today.day) < (x.month, x.day)) if pd.notnull(x) else None
-                    )
+                    df_tonghop.loc[mask, "ĐỘ TUỔI"] = tuoi[mask]
 
                     df_tonghop["RANK_RAW"] = df_tonghop.groupby("CUST_TYPE")["SỐ DƯ"].rank(method="min", ascending=False)
 
+                    # cờ TOP / RANK vector hoá trên mảng numpy (thay cho apply từng dòng)
+                    cust = df_tonghop["CUST_TYPE"].to_numpy()
+                    rank = df_tonghop["RANK_RAW"].to_numpy(dtype=float)
                     for t in ["KHDN", "KHCN"]:
+                        la_t = cust == t
                         for n in [10, 15, 20]:
-                            df_tonghop[f"TOP{n}_{t}"] = df_tonghop.apply(
-                                lambda x: "X" if x["CUST_TYPE"] == t and x["RANK_RAW"] <= n else "",
-                                axis=1,
-                            )
+                            df_tonghop[f"TOP{n}_{t}"] = np.where(la_t & (rank <= n), "X", "")
 
-                    df_tonghop["RANK"] = df_tonghop["RANK_RAW"].apply(lambda x: int(x) if x <= 20 else "")
+                    # RANK: số nguyên nếu <= 20, còn lại để trống
+                    rank_col = np.full(len(rank), "", dtype=object)
+                    top20 = rank <= 20
+                    rank_col[top20] = rank[top20].astype(int).tolist()
+                    df_tonghop["RANK"] = rank_col
 
                     df_final = df_tonghop.rename(
                         columns={
@@ -481,7 +574,7 @@ Các file uplod gồm:
                 try:
                     chi_nhanh_tc3 = validate_sol_only(chi_nhanh_tc3_raw)
 
-                    df = pd.read_excel(tc3_file, dtype=str)
+                    df = read_excel_upload(tc3_file)
                     ensure_required_columns(
                         df,
                         ["NGAY_HACH_TOAN", "ACCT_OPN_DATE", "PART_CLOSE_AMT", "SOL_ID"],
@@ -495,17 +588,17 @@ Các file uplod gồm:
 
                     df["CHENH_LECH_NGAY"] = (df["NGAY_HACH_TOAN"] - df["ACCT_OPN_DATE"]).dt.days
 
-                    df["MO_RUT_CUNG_NGAY"] = df["CHENH_LECH_NGAY"].apply(lambda x: "X" if x == 0 else "")
-                    df["MO_RUT_1_3_NGAY"] = df["CHENH_LECH_NGAY"].apply(lambda x: "X" if 0 < x <= 3 else "")
-                    df["MO_RUT_4_7_NGAY"] = df["CHENH_LECH_NGAY"].apply(lambda x: "X" if 4 <= x <= 7 else "")
-                    df["GD_LON_HON_1TY"] = df["PART_CLOSE_AMT"].apply(
-                        lambda x: "X" if pd.notna(x) and x > 1_000_000_000 else ""
-                    )
+                    # các cờ tính trên mảng numpy (NaN/NaT so sánh luôn False -> "")
+                    d = df["CHENH_LECH_NGAY"].to_numpy(dtype=float)
+                    df["MO_RUT_CUNG_NGAY"] = np.where(d == 0, "X", "")
+                    df["MO_RUT_1_3_NGAY"] = np.where((d > 0) & (d <= 3), "X", "")
+                    df["MO_RUT_4_7_NGAY"] = np.where((d >= 4) & (d <= 7), "X", "")
+                    amt = df["PART_CLOSE_AMT"].to_numpy(dtype=float)
+                    df["GD_LON_HON_1TY"] = np.where(amt > 1_000_000_000, "X", "")
 
                     today = pd.Timestamp.today().normalize()
-                    df["TRONG_THOI_HIEU_CAMERA"] = df["NGAY_HACH_TOAN"].apply(
-                        lambda x: "X" if pd.notna(x) and (today - x).days <= 90 else ""
-                    )
+                    so_ngay = (today - df["NGAY_HACH_TOAN"]).dt.days.to_numpy(dtype=float)
+                    df["TRONG_THOI_HIEU_CAMERA"] = np.where(so_ngay <= 90, "X", "")
 
                     st.success("✔ Tiêu chí 3 hoàn tất!")
                     st.dataframe(df, use_container_width=True)
@@ -3,10 +3,10 @@
 # PHÂN TÍCH TỜ KHAI HẢI QUAN (TKHQ)
 # ============================================================
 
-import io
 import re
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -14,6 +14,7 @@ from module.error_utils import (
     UserFacingError,
     ensure_required_columns,
 )
+from module.excel_utils import excel_bytes, read_excel_calamine
 
 # ============================================================
 # 🔹 CẤU HÌNH NGHIỆP VỤ
@@ -24,32 +25,64 @@ REQUIRED_COLUMNS = [
     "DECLARATION_RECEIVED_DATE",
 ]
 
+# Tên các cột kết quả
+_COL_MISS_DUE = "KHÔNG NHẬP NGÀY ĐẾN HẠN TKHQ"
+_COL_OVERDUE_DAYS = "SỐ NGÀY QUÁ HẠN TKHQ"
+_COL_OVERDUE = "QUÁ HẠN CHƯA NHẬP TKHQ"
+_COL_OVERDUE_90 = "QUÁ HẠN > 90 NGÀY CHƯA NHẬP TKHQ"
+_COL_GIA_HAN = "CÓ PHÁT SINH GIA HẠN TKHQ"
+
+# các cột đánh dấu "X" / ""
+_MARKER_COLUMNS = (_COL_MISS_DUE, _COL_OVERDUE, _COL_OVERDUE_90, _COL_GIA_HAN)
+
+# số dòng hiển thị trên màn hình (file tải xuống vẫn đủ dữ liệu)
+PREVIEW_ROWS = 1000
+
 # ============================================================
 # 🔹 HÀM TỰ NHẬN DIỆN & CHUYỂN ĐỊNH DẠNG NGÀY
 # ============================================================
 
+# ngày dạng d-m-yyyy / m-d-yyyy (dấu - hoặc /) ở đầu chuỗi; không neo cuối chuỗi
+# vì ô có thể kèm giờ phía sau. Biên dịch 1 lần khi import module
+_DATE_PATTERN = re.compile(r"^(\d{1,2})[-/](\d{1,2})[-/](\d{4})")
+# ngày ISO yyyy-mm-dd (file xuất từ hệ thống mới, hoặc ô kiểu ngày của Excel sau astype(str))
+_ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+# "giahan" cho phép dấu cách xen giữa các ký tự, không phân biệt hoa thường
+_GIAHAN_PATTERN = re.compile(r"g *i *a *h *a *n", re.IGNORECASE)
+
+
 def smart_date_parse(series: pd.Series) -> pd.Series:
     """Tự động nhận diện định dạng dd-mm-yyyy hoặc mm-dd-yyyy"""
     series = series.astype(str).str.strip()
 
-    pattern = re.compile(r"(\d{1,2})[-/](\d{1,2})[-/](\d{4})")
-    sample = series.dropna().head(20)
-
-    dayfirst_detected = False
-    for val in sample:
-        m = pattern.match(val)
-        if m:
-            day, month = int(m.group(1)), int(m.group(2))
-            if day > 12:
-                dayfirst_detected = True
-                break
-
-    return pd.to_datetime(
-        series,
-        errors="coerce",
-        dayfirst=dayfirst_detected,
-        infer_datetime_format=True,
-    )
+    sample = series.dropna().head(64)
+
+    # đa số mẫu là ISO: parse thẳng theo ISO8601, bỏ qua bước dò ngày/tháng
+    if len(sample) and sample.str.match(_ISO_DATE_PATTERN).mean() > 0.9:
+        return pd.to_datetime(series, errors="coerce", format="ISO8601")
+
+    # lấy phần "ngày" của các giá trị mẫu trong 1 lần extract; có ngày > 12 thì là dd-mm-yyyy
+    ngay = pd.to_numeric(sample.str.extract(_DATE_PATTERN)[0], errors="coerce")
+    dayfirst_detected = bool((ngay > 12).any())
+
+    # đa số mẫu có dạng d-m-yyyy: parse bằng format cố định (nhanh hơn tự suy luận)
+    if len(sample) and ngay.notna().mean() > 0.5:
+        sep = "/" if sample.str.contains("/", regex=False).mean() > 0.5 else "-"
+        fmt = f"%d{sep}%m{sep}%Y" if dayfirst_detected else f"%m{sep}%d{sep}%Y"
+        parsed = pd.to_datetime(series, errors="coerce", format=fmt)
+        # quá 10% giá trị không khớp format thì quay về cách parse tổng quát
+        if parsed.isna().sum() - series.isna().sum() <= 0.1 * series.notna().sum():
+            return parsed
+
+    return pd.to_datetime(series, errors="coerce", dayfirst=dayfirst_detected)
+
+# ============================================================
+# 🔹 ĐỌC FILE EXCEL
+# ============================================================
+
+def read_tkhq_excel(raw: bytes) -> pd.DataFrame:
+    """Đọc file TKHQ từ bytes (calamine nếu có, không thì engine mặc định)"""
+    return read_excel_calamine(raw)
 
 # ============================================================
 # 🔹 XỬ LÝ LOGIC TKHQ
@@ -60,6 +93,7 @@ def process_tkhq_data(df: pd.DataFrame, ngay_kiem_toan: pd.Timestamp) -> pd.Data
 
     # Chuẩn hoá tên cột
     df.columns = df.columns.str.strip().str.upper()
+    cot_co = frozenset(df.columns)
 
     # ✅ Check thiếu cột bắt buộc
     ensure_required_columns(df, REQUIRED_COLUMNS)
@@ -69,47 +103,77 @@ def process_tkhq_data(df: pd.DataFrame, ngay_kiem_toan: pd.Timestamp) -> pd.Data
     df["DECLARATION_RECEIVED_DATE"] = smart_date_parse(df["DECLARATION_RECEIVED_DATE"])
 
     # (1) Không nhập ngày đến hạn
-    df["KHÔNG NHẬP NGÀY ĐẾN HẠN TKHQ"] = df["DECLARATION_DUE_DATE"].isna().map(
-        lambda x: "X" if x else ""
-    )
+    df[_COL_MISS_DUE] = np.where(df["DECLARATION_DUE_DATE"].isna(), "X", "")
 
-    # (2) Số ngày quá hạn
-    df["SỐ NGÀY QUÁ HẠN TKHQ"] = df.apply(
-        lambda row: (ngay_kiem_toan - row["DECLARATION_DUE_DATE"]).days
-        if pd.notnull(row["DECLARATION_DUE_DATE"])
-        and pd.isnull(row["DECLARATION_RECEIVED_DATE"])
-        and (ngay_kiem_toan - row["DECLARATION_DUE_DATE"]).days > 0
-        else "",
-        axis=1,
-    )
-
-    so_ngay_qua_han_numeric = pd.to_numeric(
-        df["SỐ NGÀY QUÁ HẠN TKHQ"], errors="coerce"
+    # (2) Số ngày quá hạn: chỉ tính khi có ngày đến hạn, chưa nhận tờ khai và đã quá hạn
+    so_ngay = (ngay_kiem_toan - df["DECLARATION_DUE_DATE"]).dt.days.to_numpy(dtype=float)
+    qua_han = (
+        (so_ngay > 0)
+        & df["DECLARATION_RECEIVED_DATE"].isna().to_numpy()
     )
+    # giữ kiểu cũ của cột: số nguyên nếu quá hạn, "" nếu không
+    so_ngay_int = np.where(qua_han, so_ngay, 0).astype("int64").astype(object)
+    df[_COL_OVERDUE_DAYS] = np.where(qua_han, so_ngay_int, "")
 
     # (3) Quá hạn chưa nhập
-    df["QUÁ HẠN CHƯA NHẬP TKHQ"] = so_ngay_qua_han_numeric.apply(
-        lambda x: "X" if pd.notnull(x) and x > 0 else ""
-    )
+    df[_COL_OVERDUE] = np.where(qua_han, "X", "")
 
     # (4) Quá hạn > 90 ngày
-    df["QUÁ HẠN > 90 NGÀY CHƯA NHẬP TKHQ"] = so_ngay_qua_han_numeric.apply(
-        lambda x: "X" if pd.notnull(x) and x > 90 else ""
-    )
+    df[_COL_OVERDUE_90] = np.where(qua_han & (so_ngay > 90), "X", "")
 
-    # (5) Gia hạn
-    def check_gia_han(row):
-        if "AUDIT_DATE2" in row and pd.notnull(row["AUDIT_DATE2"]):
-            return "X"
-        if "DECLARATION_REF_NO" in row and isinstance(row["DECLARATION_REF_NO"], str):
-            if "giahan" in row["DECLARATION_REF_NO"].lower().replace(" ", ""):
-                return "X"
-        return ""
+    # (5) Gia hạn: có AUDIT_DATE2 hoặc số tham chiếu chứa "giahan" (bỏ khoảng trắng, không phân biệt hoa thường)
+    co_gia_han = pd.Series(False, index=df.index)
+    if "AUDIT_DATE2" in cot_co:
+        co_gia_han |= df["AUDIT_DATE2"].notna()
+    if "DECLARATION_REF_NO" in cot_co:
+        ref = df["DECLARATION_REF_NO"].astype("string")
+        co_gia_han |= ref.str.contains(_GIAHAN_PATTERN, na=False)
 
-    df["CÓ PHÁT SINH GIA HẠN TKHQ"] = df.apply(check_gia_han, axis=1)
+    df[_COL_GIA_HAN] = np.where(co_gia_han, "X", "")
+
+    # các cột đánh dấu chỉ có "X" / "": lưu dạng category (mã int8) cho nhẹ
+    for col in _MARKER_COLUMNS:
+        df[col] = pd.Categorical(df[col], categories=["", "X"])
 
     return df
 
+# ============================================================
+# 🔹 XUẤT EXCEL
+# ============================================================
+
+def tkhq_excel_bytes(df: pd.DataFrame) -> bytes:
+    """Ghi kết quả TKHQ ra xlsx (sheet KET_QUA_TKHQ)"""
+    return excel_bytes({"KET_QUA_TKHQ": df}, date_format="DD-MM-YYYY")
+
+# ============================================================
+# 🔹 CACHE KẾT QUẢ THEO (FILE, NGÀY KIỂM TOÁN)
+# ============================================================
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _load_and_process(file_bytes: bytes, audit_date_iso: str) -> pd.DataFrame:
+    """Đọc + xử lý TKHQ; cùng file và ngày kiểm toán thì rerun dùng lại kết quả"""
+    # ✅ Bắt lỗi file Excel
+    try:
+        df_raw = read_tkhq_excel(file_bytes)
+    except Exception:
+        raise UserFacingError(
+            "Không thể đọc file Excel. "
+            "Vui lòng kiểm tra định dạng hoặc nội dung file."
+        )
+
+    if df_raw.empty:
+        raise UserFacingError("File Excel không có dữ liệu.")
+
+    ngay_kiem_toan_pd = pd.to_datetime(audit_date_iso)
+
+    return process_tkhq_data(df_raw, ngay_kiem_toan_pd)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _result_excel_bytes(file_bytes: bytes, audit_date_iso: str) -> bytes:
+    """File xlsx kết quả; cache theo cùng khóa nên bấm tải lại không ghi lại file"""
+    return tkhq_excel_bytes(_load_and_process(file_bytes, audit_date_iso))
+
 # ============================================================
 # 🔹 GIAO DIỆN STREAMLIT
 # ============================================================
@@ -137,43 +201,20 @@ def run_to_khai_hq() -> None:
     if st.button("🚀 Bắt đầu xử lý", type="primary"):
         with st.spinner("⏳ Đang xử lý dữ liệu..."):
 
-            # ✅ Bắt lỗi file Excel
-            try:
-                df_raw = pd.read_excel(file)
-            except Exception:
-                raise UserFacingError(
-                    "Không thể đọc file Excel. "
-                    "Vui lòng kiểm tra định dạng hoặc nội dung file."
-                )
-
-            if df_raw.empty:
-                raise UserFacingError("File Excel không có dữ liệu.")
-
-            ngay_kiem_toan_pd = pd.to_datetime(audit_date)
-
-            df_processed = process_tkhq_data(df_raw, ngay_kiem_toan_pd)
+            file_bytes = file.getvalue()
+            audit_date_iso = audit_date.isoformat()
+            df_processed = _load_and_process(file_bytes, audit_date_iso)
 
             st.success(f"✅ Xử lý hoàn tất ({len(df_processed)} dòng)")
 
             st.subheader("📋 Kết quả phân tích")
-            st.dataframe(df_processed, use_container_width=True)
-
-            # Xuất Excel
-            output = io.BytesIO()
-            with pd.ExcelWriter(
-                output,
-                engine="openpyxl",
-                date_format="DD-MM-YYYY",
-            ) as writer:
-                df_processed.to_excel(
-                    writer,
-                    index=False,
-                    sheet_name="KET_QUA_TKHQ",
-                )
+            if len(df_processed) > PREVIEW_ROWS:
+                st.caption(f"Hiển thị {PREVIEW_ROWS:,}/{len(df_processed):,} dòng đầu tiên – tải file Excel để xem đầy đủ")
+            st.dataframe(df_processed.head(PREVIEW_ROWS), use_container_width=True)
 
             st.download_button(
                 "📥 Tải xuống file Excel kết quả",
-                data=output.getvalue(),
+                data=_result_excel_bytes(file_bytes, audit_date_iso),
                 file_name=f"ket_qua_TKHQ_{audit_date.strftime('%d%m%Y')}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )